@@ -1,11 +1,13 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Request
+from fastapi import FastAPI, HTTPException, Depends, status, Request, BackgroundTasks
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict
 import logging
 from services.auth_service import auth_service
-from datetime import datetime
-import asyncpg
+from services.cache_service import cache_service
+from db import get_async_db_connection
+import hashlib
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,6 +15,33 @@ logger = logging.getLogger(__name__)
 # 安全方案
 security = HTTPBearer()
 
+# 权限检查SQL（模块级常量，保证文本一致以命中asyncpg的预编译语句缓存）
+SQL_PERMISSION_FILE = """SELECT ucp.permission_type, uf.category_id, uf.original_filename
+                         FROM user_category_permissions ucp
+                         JOIN uploaded_files uf ON ucp.category_id = uf.category_id
+                         WHERE ucp.user_id = $1 AND uf.file_unique_id = $2"""
+
+SQL_PERMISSION_MERGED_PROJECT = """SELECT ucp.permission_type
+                                   FROM user_category_permissions ucp
+                                   JOIN merged_projects mp ON ucp.category_id = mp.category_id
+                                   WHERE ucp.user_id = $1 AND mp.id = $2"""
+
+SQL_PERMISSION_CATEGORY = "SELECT permission_type FROM user_category_permissions WHERE user_id = $1 AND category_id = $2"
+
+# 资源类型到权限查询SQL的映射
+PERMISSION_SQL_BY_RESOURCE = {
+    'file': SQL_PERMISSION_FILE,
+    'merged_project': SQL_PERMISSION_MERGED_PROJECT,
+    'category': SQL_PERMISSION_CATEGORY,
+}
+
+# 权限级别
+PERMISSION_LEVELS = {'view': 1, 'edit': 2, 'delete': 3, 'admin': 4}
+
+# 管理员用户列表缓存配置：键为 bom:admin:users:{page}:{per_page}
+ADMIN_USERS_CACHE_PREFIX = "bom:admin:users:"
+ADMIN_USERS_CACHE_TTL = 15
+
 # Pydantic模型
 class UserRegister(BaseModel):
     username: str
@@ -41,14 +70,42 @@ class PermissionCheck(BaseModel):
 class RefreshTokenRequest(BaseModel):
     refresh_token: str
 
+# 会话验证缓存：blake2b(token) -> (user_info, 过期时间戳)
+SESSION_CACHE_TTL = 30
+SESSION_CACHE_MAX_SIZE = 10000
+_session_cache: Dict[bytes, tuple] = {}
+
+def _session_cache_key(token: str) -> bytes:
+    """计算令牌在会话缓存中的键"""
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def invalidate_session_cache(token: str):
+    """从会话缓存中移除令牌（登出时调用）"""
+    _session_cache.pop(_session_cache_key(token), None)
+
 # 依赖函数
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """获取当前用户信息"""
+    """获取当前用户信息（短时间缓存验证结果）"""
     token = credentials.credentials
     logger.info(f"[AUTH] 验证用户令牌，令牌长度: {len(token) if token else 0}")
     
+    cache_key = _session_cache_key(token)
+    now = time.time()
+    cached = _session_cache.get(cache_key)
+    if cached is not None and now < cached[1]:
+        return cached[0], token
+    
     is_valid, user_info = auth_service.validate_session(token)
     
+    if is_valid:
+        # 超出容量时按插入顺序淘汰最旧的25%
+        if len(_session_cache) >= SESSION_CACHE_MAX_SIZE:
+            for key in list(_session_cache)[:SESSION_CACHE_MAX_SIZE // 4]:
+                _session_cache.pop(key, None)
+        _session_cache[cache_key] = (user_info, now + SESSION_CACHE_TTL)
+    else:
+        _session_cache.pop(cache_key, None)
+    
     if not is_valid:
         logger.warning(f"[AUTH] 令牌验证失败 - 有效: {is_valid}, 用户信息: {user_info}")
         raise HTTPException(
@@ -86,8 +143,6 @@ async def check_resource_permission_async(resource_type: str, resource_id: str,
             return True
         
         try:
-            from db import get_async_db_connection
-            
             async with get_async_db_connection() as conn:
                 # 根据资源类型查询权限
                 logger.info(f"[PERMISSION] 检查权限 - 用户ID: {user_info['id']}, 资源类型: {resource_type}, 资源ID: {resource_id}, 需要权限: {required_permission}")
@@ -95,31 +150,16 @@ async def check_resource_permission_async(resource_type: str, resource_id: str,
                 if resource_type == 'file':
                     # 通过文件所属分类检查权限
                     logger.info(f"[PERMISSION] 检查文件权限 - 用户ID: {user_info['id']}, 文件ID: {resource_id}")
-                    permission = await conn.fetchrow(
-                        """SELECT ucp.permission_type, uf.category_id, uf.original_filename
-                           FROM user_category_permissions ucp
-                           JOIN uploaded_files uf ON ucp.category_id = uf.category_id
-                           WHERE ucp.user_id = $1 AND uf.file_unique_id = $2""",
-                        user_info['id'], resource_id
-                    )
+                    permission = await conn.fetchrow(SQL_PERMISSION_FILE, user_info['id'], resource_id)
                     if permission:
                         logger.info(f"[PERMISSION] 文件权限查询成功 - 分类ID: {permission['category_id']}, 文件名: {permission['original_filename']}, 权限: {permission['permission_type']}")
                     else:
                         logger.warning(f"[PERMISSION] 文件权限查询失败 - 用户ID: {user_info['id']}, 文件ID: {resource_id}")
                 elif resource_type == 'merged_project':
                     # 通过合并项目所属分类检查权限
-                    permission = await conn.fetchrow(
-                        """SELECT ucp.permission_type 
-                           FROM user_category_permissions ucp
-                           JOIN merged_projects mp ON ucp.category_id = mp.category_id
-                           WHERE ucp.user_id = $1 AND mp.id = $2""",
-                        user_info['id'], resource_id
-                    )
+                    permission = await conn.fetchrow(SQL_PERMISSION_MERGED_PROJECT, user_info['id'], resource_id)
                 elif resource_type == 'category':
-                    permission = await conn.fetchrow(
-                        "SELECT permission_type FROM user_category_permissions WHERE user_id = $1 AND category_id = $2",
-                        user_info['id'], resource_id
-                    )
+                    permission = await conn.fetchrow(SQL_PERMISSION_CATEGORY, user_info['id'], resource_id)
                 else:
                     logger.error(f"[PERMISSION] 无效的资源类型: {resource_type}")
                     raise HTTPException(
@@ -135,9 +175,8 @@ async def check_resource_permission_async(resource_type: str, resource_id: str,
                     )
                 
                 # 权限级别检查
-                permission_levels = {'view': 1, 'edit': 2, 'delete': 3, 'admin': 4}
-                user_level = permission_levels.get(permission['permission_type'], 0)
-                required_level = permission_levels.get(required_permission, 1)
+                user_level = PERMISSION_LEVELS.get(permission['permission_type'], 0)
+                required_level = PERMISSION_LEVELS.get(required_permission, 1)
                 
                 logger.info(f"[PERMISSION] 权限级别检查 - 用户权限: {permission['permission_type']} (级别: {user_level}), 需要权限: {required_permission} (级别: {required_level})")
                 
@@ -162,6 +201,12 @@ async def check_resource_permission_async(resource_type: str, resource_id: str,
 # 异步权限检查函数（唯一实现）
 def check_resource_permission(resource_type: str, resource_id: str, required_permission: str = 'view'):
     """检查用户是否有特定资源的权限（异步实现）"""
+    # 资源类型和所需权限在声明路由时已确定，这里一次性算好
+    if resource_type not in PERMISSION_SQL_BY_RESOURCE:
+        raise ValueError(f"无效的资源类型: {resource_type}")
+    permission_sql = PERMISSION_SQL_BY_RESOURCE[resource_type]
+    required_level = PERMISSION_LEVELS.get(required_permission, 1)
+    
     async def permission_checker(current_user_data = Depends(get_current_user)):
         user_info, token = current_user_data
         
@@ -170,58 +215,26 @@ def check_resource_permission(resource_type: str, resource_id: str, required_per
             return True
         
         try:
-            from db import get_async_db_connection
-            
             async with get_async_db_connection() as conn:
-                # 根据资源类型查询权限
-                if resource_type == 'file':
-                    # 通过文件所属分类检查权限
-                    permission = await conn.fetchrow(
-                        """SELECT ucp.permission_type 
-                           FROM user_category_permissions ucp
-                           JOIN uploaded_files uf ON ucp.category_id = uf.category_id
-                           WHERE ucp.user_id = $1 AND uf.file_unique_id = $2""",
-                        user_info['id'], resource_id
-                    )
-                elif resource_type == 'merged_project':
-                    # 通过合并项目所属分类检查权限
-                    permission = await conn.fetchrow(
-                        """SELECT ucp.permission_type 
-                           FROM user_category_permissions ucp
-                           JOIN merged_projects mp ON ucp.category_id = mp.category_id
-                           WHERE ucp.user_id = $1 AND mp.id = $2""",
-                        user_info['id'], resource_id
-                    )
-                elif resource_type == 'category':
-                    permission = await conn.fetchrow(
-                        "SELECT permission_type FROM user_category_permissions WHERE user_id = $1 AND category_id = $2",
-                        user_info['id'], resource_id
-                    )
-                else:
-                    raise HTTPException(
-                        status_code=status.HTTP_403_FORBIDDEN,
-                        detail="无效的资源类型"
-                    )
-                
-                if not permission:
-                    raise HTTPException(
-                        status_code=status.HTTP_403_FORBIDDEN,
-                        detail="没有访问权限"
-                    )
-                
-                # 权限级别检查
-                permission_levels = {'view': 1, 'edit': 2, 'delete': 3, 'admin': 4}
-                user_level = permission_levels.get(permission['permission_type'], 0)
-                required_level = permission_levels.get(required_permission, 1)
-                
-                if user_level < required_level:
-                    raise HTTPException(
-                        status_code=status.HTTP_403_FORBIDDEN,
-                        detail="权限不足"
-                    )
-                
-                return True
+                permission = await conn.fetchrow(permission_sql, user_info['id'], resource_id)
+            
+            if not permission:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="没有访问权限"
+                )
             
+            # 权限级别检查
+            if PERMISSION_LEVELS.get(permission['permission_type'], 0) < required_level:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="权限不足"
+                )
+            
+            return True
+            
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Permission check error: {e}")
             raise HTTPException(
@@ -266,6 +279,7 @@ def create_auth_routes(app: FastAPI):
             )
             
             if success:
+                await cache_service.clear_pattern(f"{ADMIN_USERS_CACHE_PREFIX}*")
                 return {
                     "message": message,
                     "user_id": user_id
@@ -350,6 +364,7 @@ def create_auth_routes(app: FastAPI):
             success, message = await auth_service.logout_user_async(token, ip_address, user_agent)
             
             if success:
+                invalidate_session_cache(token)
                 return {"message": message}
             else:
                 raise HTTPException(
@@ -390,41 +405,57 @@ def create_auth_routes(app: FastAPI):
     
     @app.get("/api/auth/users")
     async def get_users(page: int = 1, per_page: int = 10, current_user_data = Depends(get_admin_user)):
-        """获取用户列表（管理员）"""
+        """获取用户列表（管理员）
+        
+        列表和总数通过 COUNT(*) OVER() 在一次查询中返回；
+        排序依赖 sql/migration_add_users_created_at_index.sql 中的 idx_users_created_at_desc 索引。
+        """
         try:
-            from db import get_async_db_connection
+            # 管理后台频繁刷新，短时间缓存分页结果
+            cache_key = f"{ADMIN_USERS_CACHE_PREFIX}{page}:{per_page}"
+            cached_response = await cache_service.get(cache_key)
+            if cached_response is not None:
+                return cached_response
             
             async with get_async_db_connection() as conn:
                 offset = (page - 1) * per_page
                 
-                # 获取用户列表
+                # 获取用户列表及总数
                 users = await conn.fetch(
-                    "SELECT id, username, email, full_name, role, is_active, created_at, last_login FROM users ORDER BY created_at DESC LIMIT $1 OFFSET $2",
+                    "SELECT id, username, email, full_name, role, is_active, created_at, last_login, COUNT(*) OVER() AS total FROM users ORDER BY created_at DESC LIMIT $1 OFFSET $2",
                     per_page, offset
                 )
                 
-                # 获取总数
-                total = await conn.fetchval("SELECT COUNT(*) FROM users")
+                if users:
+                    total = users[0]['total']
+                elif offset > 0:
+                    # 页码超出范围时窗口函数没有返回行，单独获取总数
+                    total = await conn.fetchval("SELECT COUNT(*) FROM users")
+                else:
+                    total = 0
                 
                 # 格式化日期和转换结果
                 users_list = []
                 for user in users:
                     user_dict = dict(user)
+                    user_dict.pop('total', None)
                     if user_dict['created_at']:
                         user_dict['created_at'] = user_dict['created_at'].isoformat()
                     if user_dict['last_login']:
                         user_dict['last_login'] = user_dict['last_login'].isoformat()
                     users_list.append(user_dict)
-                
-                return {
-                    "users": users_list,
-                    "pagination": {
-                        "page": page,
-                        "per_page": per_page,
-                        "total": total,
-                        "pages": (total + per_page - 1) // per_page
-                    }
+            
+            response = {
+                "users": users_list,
+                "pagination": {
+                    "page": page,
+                    "per_page": per_page,
+                    "total": total,
+                    "pages": (total + per_page - 1) // per_page
                 }
+            }
+            await cache_service.set(cache_key, response, expire=ADMIN_USERS_CACHE_TTL)
+            return response
                 
         except Exception as e:
             logger.error(f"Get users error: {e}")
@@ -434,44 +465,41 @@ def create_auth_routes(app: FastAPI):
             )
     
     @app.put("/api/auth/users/{user_id}/toggle-status")
-    async def toggle_user_status(request: Request, user_id: int, current_user_data = Depends(get_admin_user)):
+    async def toggle_user_status(request: Request, user_id: int, background_tasks: BackgroundTasks, current_user_data = Depends(get_admin_user)):
         """切换用户状态（启用/禁用）"""
         try:
-            from db import get_async_db_connection
-            
             async with get_async_db_connection() as conn:
-                # 获取当前用户状态
-                user = await conn.fetchrow("SELECT is_active FROM users WHERE id = $1", user_id)
-                
-                if not user:
-                    raise HTTPException(
-                        status_code=status.HTTP_404_NOT_FOUND,
-                        detail="用户不存在"
-                    )
-                
-                # 切换状态
-                new_status = not user['is_active']
-                await conn.execute(
-                    "UPDATE users SET is_active = $1 WHERE id = $2",
-                    new_status, user_id
+                # 切换状态并返回新状态（单次往返）
+                new_status = await conn.fetchval(
+                    "UPDATE users SET is_active = NOT is_active WHERE id = $1 RETURNING is_active",
+                    user_id
                 )
-                
-                # 记录操作日志
-                user_info, token = current_user_data
-                ip_address = request.client.host
-                user_agent = request.headers.get('User-Agent')
-                await auth_service.log_user_activity_async(
-                    user_info['id'],
-                    'toggle_user_status',
-                    'user',
-                    str(user_id),
-                    {'new_status': new_status},
-                    ip_address,
-                    user_agent
+            
+            if new_status is None:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="用户不存在"
                 )
-                
-                status_text = '启用' if new_status else '禁用'
-                return {"message": f"用户已{status_text}"}
+            
+            await cache_service.clear_pattern(f"{ADMIN_USERS_CACHE_PREFIX}*")
+            
+            # 记录操作日志（响应返回后在后台执行）
+            user_info, token = current_user_data
+            ip_address = request.client.host
+            user_agent = request.headers.get('User-Agent')
+            background_tasks.add_task(
+                auth_service.log_user_activity_async,
+                user_info['id'],
+                'toggle_user_status',
+                'user',
+                str(user_id),
+                {'new_status': new_status},
+                ip_address,
+                user_agent
+            )
+            
+            status_text = '启用' if new_status else '禁用'
+            return {"message": f"用户已{status_text}"}
                 
         except HTTPException:
             raise
@@ -483,11 +511,9 @@ def create_auth_routes(app: FastAPI):
             )
     
     @app.delete("/api/auth/users/{user_id}")
-    async def delete_user(request: Request, user_id: int, current_user_data = Depends(get_admin_user)):
+    async def delete_user(request: Request, user_id: int, background_tasks: BackgroundTasks, current_user_data = Depends(get_admin_user)):
         """删除用户（管理员）"""
         try:
-            from db import get_async_db_connection
-            
             async with get_async_db_connection() as conn:
                 # 检查要删除的用户是否存在
                 target_user = await conn.fetchrow("SELECT id, username, role FROM users WHERE id = $1", user_id)
@@ -505,35 +531,33 @@ def create_auth_routes(app: FastAPI):
                         detail="不能删除管理员账户"
                     )
                 
-                # 删除用户相关的权限记录
-                await conn.execute("DELETE FROM user_category_permissions WHERE user_id = $1", user_id)
-                
-                # 清理用户的Redis会话
-                cache_pattern = f"bom:session:{user_id}:"
-                from services.cache_service import cache_service
-                await cache_service.clear_pattern(cache_pattern)
-                
-                # 删除用户活动日志
-                await conn.execute("DELETE FROM user_activity_logs WHERE user_id = $1", user_id)
-                
-                # 删除用户
-                await conn.execute("DELETE FROM users WHERE id = $1", user_id)
-                
-                # 记录操作日志
-                user_info, token = current_user_data
-                ip_address = request.client.host
-                user_agent = request.headers.get('User-Agent')
-                await auth_service.log_user_activity_async(
-                    user_info['id'],
-                    'delete_user',
-                    'user',
-                    str(user_id),
-                    {'deleted_username': target_user['username']},
-                    ip_address,
-                    user_agent
-                )
-                
-                return {"message": f"用户 {target_user['username']} 已删除"}
+                # 在同一事务中删除权限记录、活动日志和用户
+                async with conn.transaction():
+                    await conn.execute("DELETE FROM user_category_permissions WHERE user_id = $1", user_id)
+                    await conn.execute("DELETE FROM user_activity_logs WHERE user_id = $1", user_id)
+                    await conn.execute("DELETE FROM users WHERE id = $1", user_id)
+            
+            # 事务提交后清理用户的Redis会话和权限缓存
+            cache_pattern = f"bom:session:{user_id}:*"
+            await cache_service.clear_pattern(cache_pattern)
+            await cache_service.clear_pattern(f"{ADMIN_USERS_CACHE_PREFIX}*")
+            
+            # 记录操作日志（响应返回后在后台执行）
+            user_info, token = current_user_data
+            ip_address = request.client.host
+            user_agent = request.headers.get('User-Agent')
+            background_tasks.add_task(
+                auth_service.log_user_activity_async,
+                user_info['id'],
+                'delete_user',
+                'user',
+                str(user_id),
+                {'deleted_username': target_user['username']},
+                ip_address,
+                user_agent
+            )
+            
+            return {"message": f"用户 {target_user['username']} 已删除"}
                 
         except HTTPException:
             raise
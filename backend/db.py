@@ -1,17 +1,18 @@
 import asyncpg
 import asyncio
+import functools
 import logging
+import os
+import random
 import time
 from typing import Optional
-from contextlib import asynccontextmanager
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志处理器由应用入口（main.py）统一配置
 logger = logging.getLogger(__name__)
 
 DB_CONFIG = {
     "host": "192.168.1.66",
-    "port": "7432",
+    "port": 7432,
     "database": "zxb",
     "user": "root",
     "password": "123456"
@@ -19,128 +20,233 @@ DB_CONFIG = {
 
 # 异步数据库连接池配置
 async_connection_pool = None
-async_pool_lock = asyncio.Lock()
+# 连接池大小可通过环境变量调整；默认最小与最大相同，启动时预建全部连接，避免流量突增时临时建连
+# 多进程运行（WEB_CONCURRENCY > 1）时每个进程各有一个连接池，默认大小按进程数均分，总连接数保持不变
+WEB_CONCURRENCY = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+# 只设置 DB_POOL_MAX 时最小连接数随之取相同值；最小连接数不超过最大连接数，避免建池失败
+POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX', max(2, 20 // WEB_CONCURRENCY)))
+POOL_MIN_SIZE = min(int(os.getenv('DB_POOL_MIN', POOL_MAX_SIZE)), POOL_MAX_SIZE)
+# 建池锁在首次需要时于运行中的事件循环内创建，避免导入时绑定到错误的事件循环
+async_pool_lock: Optional[asyncio.Lock] = None
 
-# 异步数据库连接字符串
-ASYNC_DATABASE_URL = f"postgresql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
+# 数据库操作重试参数（指数退避 + 随机抖动，避免数据库重启后所有请求同时重连）
+DB_RETRY_MAX_ATTEMPTS = 3
+DB_RETRY_BASE_DELAY = 0.05
+DB_RETRY_MAX_DELAY = 0.5
+
+# 视为连接层故障、可以安全重试的异常
+# 不包含 asyncio.TimeoutError：command_timeout 超时的慢查询重试只会成倍占用连接池
+DB_RETRYABLE_ERRORS = (
+    asyncpg.exceptions.ConnectionDoesNotExistError,
+    asyncpg.exceptions.CannotConnectNowError,
+    asyncpg.exceptions.TooManyConnectionsError,
+    asyncpg.exceptions.AdminShutdownError,
+    OSError,
+)
+
+# 连接借出计数，状态接口直接读取，无需访问连接池内部
+async_pool_counters = {"checked_out": 0, "total_acquired": 0}
+
+# 数据库后台探测任务：使用连接池之外的独立连接，健康检查接口只读取探测结果
+HEALTH_CHECK_INTERVAL = 10
+HEALTH_MAX_AGE = 30
+async_pool_monitor_task = None
+async_health_conn = None
+async_health_state = {"last_ok_at": None, "last_status": None}
 
 async def check_async_connection_health(conn) -> bool:
-    """检查异步数据库连接的健康状态"""
+    """检查异步数据库连接的健康状态
+    
+    只读取连接的本地状态，不发起查询；若上一个使用者遗留了未结束的事务则重置连接。
+    """
     try:
-        await conn.execute("SELECT 1")
+        if conn.is_closed():
+            return False
+        if conn.is_in_transaction():
+            await conn.reset()
         return True
     except Exception as e:
         logger.warning(f"异步连接健康检查失败: {e}")
         return False
 
+async def _init_async_connection(conn):
+    """连接池新建连接时的初始化：NUMERIC 直接解码为 float，接口层无需再逐行逐列转换 Decimal"""
+    await conn.set_type_codec('numeric', encoder=str, decoder=float, schema='pg_catalog', format='text')
+
 async def get_async_connection_pool():
     """获取异步数据库连接池，使用单例模式确保只创建一个连接池（带健康检查）"""
-    global async_connection_pool
+    global async_connection_pool, async_pool_lock
     if async_connection_pool is None:
+        if async_pool_lock is None:
+            async_pool_lock = asyncio.Lock()
         async with async_pool_lock:
             if async_connection_pool is None:
                 try:
                     async_connection_pool = await asyncpg.create_pool(
-                        ASYNC_DATABASE_URL,
-                        min_size=10,  # 最小连接数
-                        max_size=100,  # 最大连接数，增加以应对高并发
-                        command_timeout=60
+                        host=DB_CONFIG['host'],
+                        port=DB_CONFIG['port'],
+                        database=DB_CONFIG['database'],
+                        user=DB_CONFIG['user'],
+                        password=DB_CONFIG['password'],
+                        min_size=POOL_MIN_SIZE,  # 最小连接数
+                        max_size=POOL_MAX_SIZE,  # 最大连接数
+                        command_timeout=30,  # 单条语句超时，避免慢查询堆积占满连接池
+                        init=_init_async_connection,
+                        max_queries=1_000_000,  # 单连接执行次数上限，避免频繁重建连接
+                        statement_cache_size=1024,  # 每个连接缓存的预编译语句数量
+                        max_cached_statement_lifetime=0,  # 预编译语句不过期
+                        max_inactive_connection_lifetime=300.0,  # 空闲超过5分钟的连接自动回收
+                        server_settings={
+                            # 服务端TCP保活，尽早发现被NAT/防火墙断开的连接
+                            'tcp_keepalives_idle': '30',
+                            'tcp_keepalives_interval': '10',
+                            'tcp_keepalives_count': '3',
+                            'application_name': 'bom_merge'
+                        }
                     )
                     logger.info("异步数据库连接池创建成功")
-                    print("异步数据库连接池创建成功")
                 except Exception as e:
                     logger.error(f"创建异步数据库连接池失败: {e}")
-                    print(f"创建异步数据库连接池失败: {e}")
                     raise
     return async_connection_pool
 
-@asynccontextmanager
-async def get_async_db_connection():
-    """异步上下文管理器，自动管理异步数据库连接的获取和释放（带健康检查）"""
-    pool = await get_async_connection_pool()
-    conn = None
-    max_retries = 3
-    retry_delay = 1
+class _AsyncDbConnection:
+    """异步上下文管理器，自动管理异步数据库连接的获取和释放
     
-    for attempt in range(max_retries):
+    获取连接时不做探测也不做重试；空闲连接由连接池的
+    max_inactive_connection_lifetime 回收，数据库可用性由 start_async_pool_monitor 启动的后台任务探测，
+    需要重试的操作使用 with_db_retry 装饰。
+    连接池在应用启动时创建，这里直接读取模块级连接池，仅在尚未创建时才走加锁初始化。
+    使用 __slots__ 类实现，避免每次借出连接都创建生成器对象。
+    """
+    __slots__ = ('_pool', '_conn')
+
+    async def __aenter__(self):
+        self._pool = async_connection_pool or await get_async_connection_pool()
+        self._conn = await self._pool.acquire()
+        async_pool_counters["checked_out"] += 1
+        async_pool_counters["total_acquired"] += 1
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async_pool_counters["checked_out"] -= 1
         try:
-            conn = await pool.acquire()
-            if conn:
-                # 检查连接健康状态
-                if await check_async_connection_health(conn):
-                    break
-                else:
-                    # 连接不健康，释放并重试
-                    logger.warning(f"异步连接不健康，尝试重新获取连接 (尝试 {attempt + 1}/{max_retries})")
-                    await pool.release(conn)
-                    conn = None
-                    if attempt < max_retries - 1:
-                        await asyncio.sleep(retry_delay)
-                        continue
-        except Exception as e:
-            logger.error(f"获取异步数据库连接失败 (尝试 {attempt + 1}/{max_retries}): {e}")
-            if conn:
-                await pool.release(conn)
-                conn = None
-            if attempt < max_retries - 1:
-                await asyncio.sleep(retry_delay)
-                continue
-            raise
-    
-    if not conn:
-        raise Exception(f"经过 {max_retries} 次尝试后仍无法获取健康的异步数据库连接")
+            if exc_type is not None and issubclass(exc_type, (asyncpg.exceptions.ConnectionDoesNotExistError, asyncpg.exceptions.AdminShutdownError)):
+                # 连接在使用中断开（通常是数据库重启），让连接池在下次获取时重建其余旧连接
+                logger.warning("数据库连接在使用中断开，标记连接池中的现有连接过期")
+                await self._pool.expire_connections()
+        finally:
+            # asyncpg 会在释放连接时自动处理未完成的事务
+            await self._pool.release(self._conn)
+        return False
+
+get_async_db_connection = _AsyncDbConnection
+
+def with_db_retry(max_attempts: int = DB_RETRY_MAX_ATTEMPTS):
+    """数据库操作重试装饰器
     
-    try:
-        yield conn
-    except Exception as e:
-        # asyncpg 会自动处理事务回滚
-        raise e
-    finally:
-        if conn:
-            await pool.release(conn)
+    仅在连接层故障时重试整个操作，重试间隔为指数退避加随机抖动。
+    只应用于可重复执行的操作（如只读查询）。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return await func(*args, **kwargs)
+                except DB_RETRYABLE_ERRORS as e:
+                    if attempt >= max_attempts - 1:
+                        raise
+                    retry_delay = min(
+                        DB_RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, DB_RETRY_BASE_DELAY),
+                        DB_RETRY_MAX_DELAY
+                    )
+                    logger.warning(f"{func.__name__} 数据库连接异常 (尝试 {attempt + 1}/{max_attempts})，{retry_delay:.2f}s 后重试: {e}")
+                    await asyncio.sleep(retry_delay)
+        return wrapper
+    return decorator
 
 async def get_async_pool_status() -> dict:
     """获取异步连接池状态信息"""
     try:
-        pool = await get_async_connection_pool()
+        # 直接读取模块级连接池，状态查询不触发建池也不进入锁
+        pool = async_connection_pool
         status = {
             "pool_created": pool is not None,
-            "min_connections": 10,
-            "max_connections": 50,
+            "min_connections": POOL_MIN_SIZE,
+            "max_connections": POOL_MAX_SIZE,
+            # get_size/get_idle_size 为 asyncpg 公开接口，只读取计数，用于核对连接池大小配置
+            "size": pool.get_size() if pool is not None else 0,
+            "idle": pool.get_idle_size() if pool is not None else 0,
+            "checked_out": async_pool_counters["checked_out"],
+            "total_acquired": async_pool_counters["total_acquired"],
+            "last_health_ok_at": async_health_state["last_ok_at"],
             "timestamp": time.time()
         }
         
-        # 获取连接池的详细状态
-        if pool:
-            status["current_size"] = pool.get_size()
-            status["idle_connections"] = pool.get_idle_size()
-        
         return status
     except Exception as e:
         logger.error(f"获取异步连接池状态失败: {e}")
         return {"error": str(e), "timestamp": time.time()}
 
 async def perform_async_pool_health_check() -> bool:
-    """执行异步连接池健康检查"""
-    try:
-        # 尝试获取并测试一个连接
-        async with get_async_db_connection() as conn:
-            health_ok = await check_async_connection_health(conn)
-            if health_ok:
-                logger.info("异步连接池健康检查通过")
-                return True
-            else:
-                logger.warning("异步连接池健康检查失败：连接不健康")
-                return False
-    except Exception as e:
-        logger.error(f"异步连接池健康检查异常: {e}")
-        return False
+    """执行异步连接池健康检查
+    
+    只读取后台探测任务记录的最近成功时间，不从连接池借出连接，
+    连接池繁忙时健康检查也不会与业务查询争用连接。
+    """
+    last_ok_at = async_health_state["last_ok_at"]
+    return last_ok_at is not None and time.time() - last_ok_at < HEALTH_MAX_AGE
+
+async def _async_health_loop():
+    """后台定期用独立连接探测数据库，记录探测结果；探测失败时让连接池重建连接"""
+    global async_health_conn
+    while True:
+        try:
+            if async_health_conn is None or not await check_async_connection_health(async_health_conn):
+                async_health_conn = await asyncpg.connect(
+                    host=DB_CONFIG['host'],
+                    port=DB_CONFIG['port'],
+                    database=DB_CONFIG['database'],
+                    user=DB_CONFIG['user'],
+                    password=DB_CONFIG['password'],
+                    timeout=HEALTH_CHECK_INTERVAL,
+                    server_settings={'application_name': 'bom_merge_health'}
+                )
+            # 本地状态无法发现服务端宕机，后台探测仍需一次真实往返
+            healthy = await async_health_conn.fetchval("SELECT 1", timeout=HEALTH_CHECK_INTERVAL) == 1
+        except Exception as e:
+            logger.warning(f"数据库健康探测连接失败: {e}")
+            healthy = False
+        
+        async_health_state["last_status"] = healthy
+        if healthy:
+            async_health_state["last_ok_at"] = time.time()
+        else:
+            if async_health_conn is not None:
+                async_health_conn.terminate()
+                async_health_conn = None
+            if async_connection_pool is not None:
+                await async_connection_pool.expire_connections()
+        
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+def start_async_pool_monitor():
+    """启动数据库后台探测任务，通常在应用启动时调用"""
+    global async_pool_monitor_task
+    if async_pool_monitor_task is None or async_pool_monitor_task.done():
+        async_pool_monitor_task = asyncio.create_task(_async_health_loop())
 
 async def close_async_connections():
     """关闭所有异步数据库连接，通常在应用关闭时调用"""
-    global async_connection_pool
+    global async_connection_pool, async_pool_monitor_task, async_health_conn
+    if async_pool_monitor_task is not None:
+        async_pool_monitor_task.cancel()
+        async_pool_monitor_task = None
+    if async_health_conn is not None:
+        async_health_conn.terminate()
+        async_health_conn = None
     if async_connection_pool:
         await async_connection_pool.close()
         async_connection_pool = None
         logger.info("所有异步数据库连接已关闭")
-        print("所有异步数据库连接已关闭")
@@ -1,32 +1,67 @@
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File, Query, Request, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from services.excel_import import  import_excel_to_db_async
 from services.cache_service import cache_service
-from db import get_async_db_connection, get_async_pool_status, perform_async_pool_health_check
+from services.auth_service import auth_service
+from db import POOL_MAX_SIZE, get_async_db_connection, get_async_connection_pool, start_async_pool_monitor, close_async_connections, get_async_pool_status, perform_async_pool_health_check
+import asyncio
+import asyncpg
+import functools
+import orjson
 import os
+import queue
 import traceback
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
+from tempfile import NamedTemporaryFile
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
 from project_notes import router as project_notes_router
 from auth_fastapi import create_auth_routes, get_current_user, get_admin_user
 from permission_fastapi import create_permission_routes
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("upload_api.log"),
-        logging.StreamHandler()
-    ]
-)
+# 配置日志：根记录器只把日志放入队列，写文件和终端由后台线程完成（消息本身仍在调用线程中格式化）
+# 使用 force=True，覆盖其他模块导入时调用 basicConfig 留下的处理器，不受导入顺序影响
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = [logging.FileHandler("upload_api.log"), logging.StreamHandler()]
+for _log_handler in _log_handlers:
+    _log_handler.setFormatter(_log_formatter)
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)], force=True)
 logger = logging.getLogger("upload_api")
 
+def _orjson_default(obj):
+    """orjson 无法原生序列化的类型：asyncpg Record 直接转换为字典"""
+    if isinstance(obj, asyncpg.Record):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
+
+class RecordJSONResponse(ORJSONResponse):
+    """可直接序列化 asyncpg Record 列表的 JSON 响应，datetime 由 orjson 输出为 ISO 格式"""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_orjson_default)
+
+# 超过该行数的结果在线程池中序列化，避免阻塞事件循环
+LARGE_RESULT_ROWS = 1000
+
+async def json_response_offloaded(content: list) -> Response:
+    """大结果集在线程池中序列化为 JSON，小结果集直接在事件循环中序列化"""
+    if len(content) <= LARGE_RESULT_ROWS:
+        return RecordJSONResponse(content)
+    loop = asyncio.get_running_loop()
+    body = await loop.run_in_executor(None, functools.partial(orjson.dumps, content, default=_orjson_default))
+    return Response(content=body, media_type="application/json")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理器"""
+    _log_listener.start()
+    
     # 启动时初始化缓存服务
     try:
         await cache_service.initialize()
@@ -36,16 +71,41 @@ async def lifespan(app: FastAPI):
         # 即使缓存初始化失败，应用也应该继续运行，只是使用内存缓存
         logger.info("应用将继续运行，使用内存缓存作为备选方案")
     
+    # 启动时创建数据库连接池，避免首个请求承担建池开销
+    try:
+        await get_async_connection_pool()
+        logger.info("数据库连接池初始化成功")
+    except Exception as e:
+        logger.error(f"数据库连接池初始化失败: {e}")
+        # 首次请求时仍会尝试重新创建连接池
+    
+    # 无论建池是否成功都启动后台探测，探测任务自行处理连接失败，数据库恢复后健康检查随之恢复
+    start_async_pool_monitor()
+    
     yield  # 应用运行期间
     
     # 关闭时清理资源
+    try:
+        await auth_service.flush_activity_logs()
+    except Exception as e:
+        logger.error(f"写入剩余用户活动日志时出错: {e}")
+    
     try:
         await cache_service.close()
         logger.info("缓存服务已关闭")
     except Exception as e:
         logger.error(f"关闭缓存服务时出错: {e}")
+    
+    try:
+        await close_async_connections()
+    except Exception as e:
+        logger.error(f"关闭数据库连接池时出错: {e}")
+    
+    # 最后停止日志线程，写出队列中剩余的日志
+    _log_listener.stop()
 
-app = FastAPI(lifespan=lifespan)
+# 默认使用 orjson 序列化响应（同时支持 asyncpg Record 与 datetime）
+app = FastAPI(lifespan=lifespan, default_response_class=RecordJSONResponse)
 
 # 添加CORS中间件，允许跨域请求
 app.add_middleware(
@@ -86,59 +146,51 @@ async def get_uploaded_files(current_user_data = Depends(get_current_user)):
         user_info, token = current_user_data
         user_id = user_info['id']
         user_role = user_info['role']
-        logger.info(f"用户 {user_id} (角色: {user_role}) 请求上传文件列表")
+        logger.info("用户 %s (角色: %s) 请求上传文件列表", user_id, user_role)
         
         # 构建缓存键，包含用户ID和角色
         cache_key = f"uploaded_files:{user_id}:{user_role}"
         cached_files = await cache_service.get(cache_key)
         if cached_files is not None:
-            logger.debug(f"从缓存获取用户{user_id}的上传文件列表")
-            return cached_files
+            logger.debug("从缓存获取用户%s的上传文件列表", user_id)
+            return RecordJSONResponse(cached_files)
         
         # 缓存未命中，查询数据库
+        # upload_time 在SQL中转为文本（"YYYY-MM-DD HH:MM:SS[.ffffff]"），与此前接口返回的 str(datetime) 格式一致
         async with get_async_db_connection() as conn:
             if user_role == 'admin':
                 # 管理员可以看到所有文件
                 rows = await conn.fetch("""
                     SELECT file_unique_id, original_filename, project_name, 
-                           file_size, upload_time, status, rows_imported, category_id
+                           file_size, upload_time::text AS upload_time, status, rows_imported, category_id
                     FROM uploaded_files 
-                    ORDER BY upload_time DESC
+                    ORDER BY uploaded_files.upload_time DESC
                 """)
-                logger.info(f"管理员查询结果: 找到 {len(rows)} 个上传文件")
+                logger.debug("管理员查询结果: 找到 %s 个上传文件", len(rows))
             else:
                 # 普通用户只能看到有权限的分类下的文件
                 rows = await conn.fetch("""
                     SELECT uf.file_unique_id, uf.original_filename, uf.project_name, 
-                           uf.file_size, uf.upload_time, uf.status, uf.rows_imported, uf.category_id
+                           uf.file_size, uf.upload_time::text AS upload_time, uf.status, uf.rows_imported, uf.category_id
                     FROM uploaded_files uf
                     JOIN user_category_permissions ucp ON uf.category_id = ucp.category_id
                     WHERE ucp.user_id = $1 AND ucp.permission_type IN ('view', 'edit')
                     ORDER BY uf.upload_time DESC
                 """, user_id)
-                logger.info(f"普通用户查询结果: 找到 {len(rows)} 个有权限的上传文件")
-        
-        # 转换查询结果
-        result = []
-        for row in rows:
-            file_dict = dict(row)
-            # 转换时间戳为字符串
-            if 'upload_time' in file_dict and file_dict['upload_time']:
-                file_dict['upload_time'] = str(file_dict['upload_time'])
-            result.append(file_dict)
+                logger.debug("普通用户查询结果: 找到 %s 个有权限的上传文件", len(rows))
         
         # 缓存上传文件列表（5分钟，因为权限可能变化较频繁）
-        await cache_service.set(cache_key, result, expire=300)
-        logger.debug(f"缓存用户{user_id}的上传文件列表，共{len(result)}个文件")
+        await cache_service.set(cache_key, rows, expire=300)
+        logger.debug("缓存用户%s的上传文件列表，共%s个文件", user_id, len(rows))
         
-        return result
+        # 直接序列化 Record，不再逐行构造中间字典
+        return RecordJSONResponse(rows)
         
     except HTTPException as http_exc:
-        logger.error(f"HTTP异常: {http_exc.status_code} - {http_exc.detail}")
+        logger.error("HTTP异常: %s - %s", http_exc.status_code, http_exc.detail)
         raise http_exc
     except Exception as e:
-        logger.error(f"获取上传文件列表时出错: {str(e)}")
-        logger.error(f"详细错误信息: {traceback.format_exc()}")
+        logger.error("获取上传文件列表时出错: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"获取上传文件列表时出错: {str(e)}"})
 
 
@@ -151,8 +203,7 @@ async def get_single_uploaded_file(file_unique_id: str):
             return JSONResponse(status_code=404, content={"error": f"未找到文件ID为 {file_unique_id} 的文件"})
         return file_info
     except Exception as e:
-        error_detail = f"获取文件信息失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        print(error_detail)
+        logger.error("获取文件信息失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"获取文件信息失败: {str(e)}"})
 
 # 删除上传文件API - 管理员权限
@@ -166,13 +217,12 @@ async def delete_uploaded_file(file_unique_id: str, current_user_data = Depends(
         user_info, token = current_user_data
         user_id = user_info['id']
         user_role = user_info['role']
-        logger.info(f"[DELETE] 管理员用户 {user_id} (角色: {user_role}) 请求删除文件 {file_unique_id}")
-        logger.info(f"[DELETE] 请求时间: {datetime.now().isoformat()}")
-        logger.info(f"[DELETE] 文件唯一ID: {file_unique_id}")
+        logger.info("[DELETE] 管理员用户 %s (角色: %s) 请求删除文件 %s", user_id, user_role, file_unique_id)
+        logger.debug("[DELETE] 文件唯一ID: %s", file_unique_id)
         
         async with get_async_db_connection() as conn:
             # 首先检查文件是否存在
-            logger.info(f"[DELETE] 开始查询文件信息，文件ID: {file_unique_id}")
+            logger.debug("[DELETE] 开始查询文件信息，文件ID: %s", file_unique_id)
             file_info = await conn.fetchrow("""
                 SELECT id, original_filename, project_name, category_id
                 FROM uploaded_files 
@@ -180,103 +230,70 @@ async def delete_uploaded_file(file_unique_id: str, current_user_data = Depends(
             """, file_unique_id)
             
             if not file_info:
-                logger.warning(f"[DELETE] 文件未找到，文件ID: {file_unique_id}")
+                logger.warning("[DELETE] 文件未找到，文件ID: %s", file_unique_id)
                 return JSONResponse(status_code=404, content={"error": f"未找到文件ID为 {file_unique_id} 的文件"})
             
             original_filename = file_info['original_filename']
             project_name = file_info['project_name']
             category_id = file_info['category_id']
-            logger.info(f"[DELETE] 文件信息查询成功: {original_filename} (项目: {project_name}, 分类ID: {category_id})")
+            logger.debug("[DELETE] 文件信息查询成功: %s (项目: %s, 分类ID: %s)", original_filename, project_name, category_id)
             
             # 删除相关的parts_library数据
-            logger.info(f"[DELETE] 开始删除parts_library数据，文件ID: {file_unique_id}")
+            logger.debug("[DELETE] 开始删除parts_library数据，文件ID: %s", file_unique_id)
             deleted_parts = await conn.execute("""
                 DELETE FROM parts_library 
                 WHERE file_unique_id = $1
             """, file_unique_id)
-            logger.info(f"[DELETE] parts_library数据删除完成")
+            logger.debug("[DELETE] parts_library数据删除完成")
             
             # 删除uploaded_files记录
-            logger.info(f"[DELETE] 开始删除uploaded_files记录，文件ID: {file_unique_id}")
+            logger.debug("[DELETE] 开始删除uploaded_files记录，文件ID: %s", file_unique_id)
             deleted_files = await conn.execute("""
                 DELETE FROM uploaded_files 
                 WHERE file_unique_id = $1
             """, file_unique_id)
-            logger.info(f"[DELETE] uploaded_files记录删除完成")
+            logger.debug("[DELETE] uploaded_files记录删除完成")
             
-            # 清理相关缓存
-            try:
-                # 清理文件列表缓存
-                if cache_service.redis_client:
-                    cache_keys = await cache_service.redis_client.keys("uploaded_files:*")
-                    if cache_keys:
-                        await cache_service.redis_client.delete(*cache_keys)
-                        logger.info(f"清理了 {len(cache_keys)} 个上传文件缓存")
-                else:
-                    # 内存缓存清理
-                    keys_to_delete = [key for key in cache_service._memory_cache.keys() 
-                                    if key.startswith("uploaded_files:")]
-                    for key in keys_to_delete:
-                        del cache_service._memory_cache[key]
-                    logger.info(f"清理了 {len(keys_to_delete)} 个内存上传文件缓存")
-            except Exception as cache_error:
-                logger.warning(f"清理缓存失败: {cache_error}")
+            # 清理文件列表缓存
+            deleted_count = await cache_service.invalidate_tag("uploaded_files")
+            logger.debug("清理了 %s 个上传文件缓存", deleted_count)
             
-            logger.info(f"文件删除成功: {file_unique_id} - {original_filename} (项目: {project_name})")
+            logger.info("文件删除成功: %s - %s (项目: %s)", file_unique_id, original_filename, project_name)
             return {"status": "success", "message": f"文件 {original_filename} 删除成功"}
             
     except HTTPException as http_exc:
-        logger.error(f"HTTP异常: {http_exc.status_code} - {http_exc.detail}")
+        logger.error("HTTP异常: %s - %s", http_exc.status_code, http_exc.detail)
         raise http_exc
     except Exception as e:
-        logger.error(f"删除文件失败: {str(e)}")
-        logger.error(f"详细错误信息: {traceback.format_exc()}")
+        logger.error("删除文件失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"删除文件失败: {str(e)}"})
 
 # 更新文件名API
 @app.put("/uploaded_files/{file_unique_id}/rename")
 async def rename_uploaded_file(file_unique_id: str, new_filename: str = Query(..., description="新的文件名")):
     try:
-        # 首先检查文件是否存在
-        file_info = await get_uploaded_file_async(file_unique_id)
-        if not file_info:
+        # 更新文件名，同时返回更新后的文件信息；文件不存在时返回 None
+        updated_file_info = await update_file_name_async(file_unique_id, new_filename)
+        if not updated_file_info:
             return JSONResponse(status_code=404, content={"error": f"未找到文件ID为 {file_unique_id} 的文件"})
         
-        # 更新文件名
-        success = await update_file_name_async(file_unique_id, new_filename)
-        
-        if success:
-            # 获取更新后的文件信息
-            updated_file_info = await get_uploaded_file_async(file_unique_id)
-            return {"status": "success", "message": "文件名更新成功", "file": updated_file_info}
-        else:
-            return JSONResponse(status_code=500, content={"error": "文件名更新失败"})
+        return {"status": "success", "message": "文件名更新成功", "file": updated_file_info}
     except Exception as e:
-        error_detail = f"更新文件名失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        print(error_detail)
+        logger.error("更新文件名失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"更新文件名失败: {str(e)}"})
 
 # 更新项目名称API
 @app.put("/uploaded_files/{file_unique_id}/update_project")
 async def update_uploaded_file_project(file_unique_id: str, new_project_name: str = Query(..., description="新的项目名称")):
     try:
-        # 首先检查文件是否存在
-        file_info = await get_uploaded_file_async(file_unique_id)
-        if not file_info:
+        # 更新项目名称，同时返回更新后的文件信息；文件不存在时返回 None
+        updated_file_info = await update_project_name_async(file_unique_id, new_project_name)
+        if not updated_file_info:
             return JSONResponse(status_code=404, content={"error": f"未找到文件ID为 {file_unique_id} 的文件"})
         
-        # 更新项目名称
-        success = await update_project_name_async(file_unique_id, new_project_name)
-        
-        if success:
-            # 获取更新后的文件信息
-            updated_file_info = await get_uploaded_file_async(file_unique_id)
-            return {"status": "success", "message": "项目名称更新成功", "file": updated_file_info}
-        else:
-            return JSONResponse(status_code=500, content={"error": "项目名称更新失败"})
+        return {"status": "success", "message": "项目名称更新成功", "file": updated_file_info}
     except Exception as e:
-        error_detail = f"更新项目名称失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        print(error_detail)
+        logger.error("更新项目名称失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"更新项目名称失败: {str(e)}"})
 
 # 获取文件映射API
@@ -290,8 +307,7 @@ async def get_all_file_mappings(
         mappings = await get_file_mappings_async(file_unique_id, entity_type, entity_id)
         return mappings
     except Exception as e:
-        error_detail = f"获取文件映射失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        print(error_detail)
+        logger.error("获取文件映射失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"获取文件映射失败: {str(e)}"})
 
 # 获取指定文件的映射API
@@ -301,8 +317,7 @@ async def get_file_mappings_by_id(file_unique_id: str):
         mappings = await get_file_mappings_async(file_unique_id)
         return mappings
     except Exception as e:
-        error_detail = f"获取文件映射失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        print(error_detail)
+        logger.error("获取文件映射失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"获取文件映射失败: {str(e)}"})
 
 
@@ -314,9 +329,6 @@ async def upload_parts_excel(
     files: list[UploadFile] = File(...),
     project_name: str = Query(default=None)
 ):
-    total_count = 0
-    results = []
-    
     # 从FormData中获取category_id
     form_data = await request.form()
     category_id = form_data.get('category_id')
@@ -327,9 +339,10 @@ async def upload_parts_excel(
             category_id = None
     
     # 添加日志记录接收到的参数
-    logger.info(f"上传文件请求 - 项目名: {project_name}, 分类ID: {category_id}, 文件数量: {len(files)}")
+    logger.info("上传文件请求 - 项目名: %s, 分类ID: %s, 文件数量: %s", project_name, category_id, len(files))
     
-    for file in files:
+    async def _process(file):
+        """导入单个上传文件，返回该文件的处理结果"""
         # 如果 project_name 为空，则用文件名（去扩展名）作为默认值
         current_project_name = project_name
         if not current_project_name:
@@ -337,26 +350,29 @@ async def upload_parts_excel(
             current_project_name = os.path.splitext(filename)[0]  # 结果 s500
 
         # 为每个文件生成唯一ID
-        file_unique_id = str(uuid.uuid4())
-        logger.info(f"生成文件唯一ID: {file_unique_id}")
+        fid = uuid.uuid4()
+        file_unique_id = str(fid)
+        logger.debug("生成文件唯一ID: %s", file_unique_id)
         
         # 使用唯一ID作为上传批次的一部分
-        upload_batch = f"batch_{current_project_name}_{file_unique_id[:8]}"
+        upload_batch = f"batch_{current_project_name}_{fid.hex[:8]}"
         
-        # 获取文件大小
-        file.file.seek(0, os.SEEK_END)
-        file_size = file.file.tell()
-        file.file.seek(0)  # 重置文件指针到开始位置
+        # 获取文件大小：优先使用解析表单时已记录的大小，缺失时才定位到文件末尾计算
+        file_size = file.size
+        if file_size is None:
+            file.file.seek(0, os.SEEK_END)
+            file_size = file.file.tell()
+            file.file.seek(0)  # 重置文件指针到开始位置
         
-        logger.info(f"开始处理上传文件: {file.filename}, 大小: {file_size} 字节, 项目名称: {current_project_name}, 文件ID: {file_unique_id}, 分类ID: {category_id}")
+        logger.info("开始处理上传文件: %s, 大小: %s 字节, 项目名称: %s, 文件ID: %s, 分类ID: %s", file.filename, file_size, current_project_name, file_unique_id, category_id)
         
         try:
             # 导入Excel数据到零件库
-            logger.info(f"调用import_excel_to_db_async异步导入Excel数据, 文件: {file.filename}")
+            logger.debug("调用import_excel_to_db_async异步导入Excel数据, 文件: %s", file.filename)
             count = await import_excel_to_db_async(file.file, upload_batch, current_project_name, file_unique_id)
             
             # 保存文件信息到uploaded_files表
-            logger.info(f"导入成功，保存文件信息到uploaded_files表, 文件: {file.filename}, 导入行数: {count}, 分类ID: {category_id}")
+            logger.debug("导入成功，保存文件信息到uploaded_files表, 文件: %s, 导入行数: %s, 分类ID: %s", file.filename, count, category_id)
             await save_uploaded_file_info_async(
                 original_filename=file.filename,
                 file_size=file_size,
@@ -366,52 +382,67 @@ async def upload_parts_excel(
                 rows_imported=count,
                 category_id=category_id
             )
-            logger.info(f"文件信息保存成功: {file.filename}, 分类ID已设置为: {category_id}")
+            logger.debug("文件信息保存成功: %s, 分类ID已设置为: %s", file.filename, category_id)
             
-            total_count += count
-            results.append({
+            return {
                 "filename": file.filename,
                 "project_name": current_project_name,
                 "file_id": file_unique_id,
                 "status": "imported",
                 "rows_imported": count
-            })
+            }
         except Exception as e:
             error_detail = f"导入错误: {str(e)}\n详细信息: {traceback.format_exc()}"
-            logger.error(f"文件 {file.filename} 导入失败: {str(e)}")
-            logger.error(f"详细错误信息: {traceback.format_exc()}")
+            logger.error("文件 %s 导入失败: %s", file.filename, e, exc_info=True)
             
             # 记录客户端信息
             client_host = getattr(request, 'client', None)
             if client_host:
-                logger.error(f"客户端信息: {client_host.host}:{client_host.port}")
+                logger.error("客户端信息: %s:%s", client_host.host, client_host.port)
             
             # 不再保存失败记录到uploaded_files表，避免出现"空壳"记录
-            logger.info(f"导入失败，不保存记录到uploaded_files表，文件: {file.filename}")
+            logger.info("导入失败，不保存记录到uploaded_files表，文件: %s", file.filename)
                 
-            results.append({
+            return {
                 "filename": file.filename,
                 "project_name": current_project_name,
                 "file_id": file_unique_id,
                 "status": "failed",
                 "error": str(e),
                 "detail": error_detail
-            })
+            }
+    
+    # 多个文件并发导入，限制并发数以免占满连接池影响其他接口
+    semaphore = asyncio.Semaphore(max(1, min(len(files), POOL_MAX_SIZE - 2)))
+    
+    async def _process_limited(file):
+        async with semaphore:
+            return await _process(file)
+    
+    results = await asyncio.gather(*(_process_limited(file) for file in files))
+    
+    # 单次遍历统计导入成功的文件数和总行数
+    total_count = 0
+    imported_ok = 0
+    for result in results:
+        if result["status"] == "imported":
+            imported_ok += 1
+            total_count += result["rows_imported"]
     
     # 如果有文件上传成功，清除相关缓存
-    if any(result["status"] == "imported" for result in results):
-        # 清除所有上传文件列表缓存（包括用户特定的缓存）
-        await cache_service.clear_pattern("uploaded_files:*")
-        # 清除项目列表缓存
-        await cache_service.delete("projects:all")
-        await cache_service.delete("project_names:all")
-        # 清除用户项目缓存
-        await cache_service.clear_pattern("user_projects:*")
+    if imported_ok:
+        # 并发清除上传文件列表缓存（包括用户特定的缓存）、项目列表缓存和用户项目缓存
+        await asyncio.gather(
+            cache_service.invalidate_tag("uploaded_files"),
+            cache_service.delete("projects:all"),
+            cache_service.delete("project_names:all"),
+            cache_service.clear_pattern("user_projects:*")
+        )
         logger.info("文件上传成功，已清除相关缓存")
     
-    if all(result["status"] == "imported" for result in results):
+    if imported_ok == len(results):
         return {"status": "success", "rows_imported": total_count, "details": results}
-    elif any(result["status"] == "imported" for result in results):
+    elif imported_ok:
         return {"status": "partial_success", "rows_imported": total_count, "details": results}
     else:
         return JSONResponse(status_code=500, content={"status": "error", "details": results})
@@ -455,47 +486,31 @@ async def get_user_projects(current_user_data = Depends(get_current_user)):
         user_id = user_info['id']
         user_role = user_info.get('role', 'user')
         
-        logger.info(f"用户 {user_id} (角色: {user_role}) 请求获取项目列表")
+        logger.info("用户 %s (角色: %s) 请求获取项目列表", user_id, user_role)
         
         # 尝试从缓存获取用户项目列表
         cache_key = f"user_projects:{user_id}"
         cached_projects = await cache_service.get(cache_key)
         if cached_projects is not None:
-            logger.debug(f"从缓存获取用户{user_id}的项目列表")
+            logger.debug("从缓存获取用户%s的项目列表", user_id)
             return cached_projects
         
         # 缓存未命中，查询数据库
-        logger.info(f"缓存未命中，开始查询数据库 - 用户ID: {user_id}, 角色: {user_role}")
+        logger.debug("缓存未命中，开始查询数据库 - 用户ID: %s, 角色: %s", user_id, user_role)
         
         async with get_async_db_connection() as conn:
             if user_role == 'admin':
                 # 管理员可以看到所有项目
-                logger.info("管理员用户，查询所有项目")
+                logger.debug("管理员用户，查询所有项目")
                 rows = await conn.fetch("""
                     SELECT DISTINCT project_name, upload_batch, file_unique_id, created_at
                     FROM parts_library
                     ORDER BY created_at DESC
                 """)
-                logger.info(f"管理员查询结果: 找到 {len(rows)} 个项目")
+                logger.debug("管理员查询结果: 找到 %s 个项目", len(rows))
             else:
                 # 普通用户只能看到有权限的项目（通过分类权限）
-                logger.info(f"普通用户，查询有权限的项目 - 用户ID: {user_id}")
-                
-                # 先检查用户是否有任何分类权限
-                permission_rows = await conn.fetch("""
-                    SELECT category_id, permission_type FROM user_category_permissions 
-                    WHERE user_id = $1
-                """, user_id)
-                logger.info(f"用户 {user_id} 的分类权限: {[(row['category_id'], row['permission_type']) for row in permission_rows]}")
-                
-                # 检查uploaded_files表中的category_id分布
-                category_stats = await conn.fetch("""
-                    SELECT category_id, COUNT(*) as file_count 
-                    FROM uploaded_files 
-                    WHERE category_id IS NOT NULL 
-                    GROUP BY category_id
-                """)
-                logger.info(f"uploaded_files表中的分类统计: {[(row['category_id'], row['file_count']) for row in category_stats]}")
+                logger.debug("普通用户，查询有权限的项目 - 用户ID: %s", user_id)
                 
                 rows = await conn.fetch("""
                     SELECT DISTINCT pl.project_name, pl.upload_batch, pl.file_unique_id, pl.created_at
@@ -505,19 +520,18 @@ async def get_user_projects(current_user_data = Depends(get_current_user)):
                     WHERE ucp.user_id = $1 AND ucp.permission_type IN ('view', 'edit')
                     ORDER BY pl.created_at DESC
                 """, user_id)
-                logger.info(f"普通用户查询结果: 找到 {len(rows)} 个有权限的项目")
+                logger.debug("普通用户查询结果: 找到 %s 个有权限的项目", len(rows))
         
         result = [{"project_name": row['project_name'], "upload_batch": row['upload_batch'], "file_unique_id": row['file_unique_id']} for row in rows]
         
         # 缓存用户项目列表（5分钟，因为权限可能变化较频繁）
         await cache_service.set(cache_key, result, expire=300)
-        logger.debug(f"缓存用户{user_id}的项目列表")
+        logger.debug("缓存用户%s的项目列表", user_id)
         
-        logger.info(f"成功返回用户 {user_id} 的项目列表，共 {len(result)} 个项目")
+        logger.debug("成功返回用户 %s 的项目列表，共 %s 个项目", user_id, len(result))
         return result
     except Exception as e:
-        error_detail = f"查询用户项目时出错: {str(e)}\n详细信息: {traceback.format_exc()}"
-        logger.error(error_detail)
+        logger.error("查询用户项目时出错: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"查询用户项目时出错: {str(e)}"})
 
 @app.get("/project_names")
@@ -561,7 +575,7 @@ async def get_parts(project_name: str = Query(..., description="项目名称")):
         cached_parts = await cache_service.get(cache_key)
         if cached_parts is not None:
             logger.debug(f"从缓存获取项目{project_name}的零部件列表")
-            return cached_parts
+            return await json_response_offloaded(cached_parts)
         
         # 缓存未命中，查询数据库
         async with get_async_db_connection() as conn:
@@ -571,21 +585,13 @@ async def get_parts(project_name: str = Query(..., description="项目名称")):
                 ORDER BY id
             """, project_name)
         
-        # 转换查询结果
-        result = []
-        for row in rows:
-            part_dict = dict(row)
-            # 转换 Decimal 类型为 float
-            for key, value in part_dict.items():
-                if hasattr(value, '__float__'):
-                    part_dict[key] = float(value)
-            result.append(part_dict)
-        
-        # 缓存零部件数据（5分钟）
-        await cache_service.set(cache_key, result, expire=300)
-        logger.debug(f"缓存项目{project_name}的零部件列表，共{len(result)}条记录")
+        # NUMERIC 已由连接层的类型编解码器解码为 float，Record 可直接缓存和序列化
+        # 缓存零部件数据（5分钟）；不存在的项目不缓存空结果，避免拼写错误的项目名长期占用缓存
+        if rows:
+            await cache_service.set(cache_key, rows, expire=300)
+            logger.debug(f"缓存项目{project_name}的零部件列表，共{len(rows)}条记录")
         
-        return result
+        return await json_response_offloaded(rows)
     except Exception as e:
         logger.error(f"获取零部件数据时出错: {str(e)}")
         return JSONResponse(status_code=500, content={"error": f"获取零部件数据时出错: {str(e)}"})
@@ -629,31 +635,55 @@ class PartUpdate(BaseModel):
 class UpdatePartsRequest(BaseModel):
     parts: List[PartUpdate]
 
+# 零部件的业务字段（零件库与合并零部件共用，顺序与批量写入语句一致）
+PART_FIELDS = (
+    'level', 'part_code', 'part_name', 'spec', 'version', 'material', 'unit_count_per_level',
+    'unit_weight_kg', 'total_weight_kg', 'part_property', 'drawing_size', 'reference_number',
+    'purchase_status', 'process_route', 'remark'
+)
+
+# 批量更新零部件：每列作为一个数组参数，值为 NULL 的字段保持原值不变
+UPDATE_PARTS_SQL = f"""
+    UPDATE parts_library
+    SET {', '.join(f"{field} = COALESCE(v.{field}, parts_library.{field})" for field in PART_FIELDS)}
+    FROM unnest($1::int[], {', '.join(f"${i}::text[]" for i in range(2, len(PART_FIELDS) + 2))})
+        AS v(id, {', '.join(PART_FIELDS)})
+    WHERE parts_library.id = v.id
+"""
+
+# 批量写入合并零部件：$1 为合并项目ID，$2 为创建时间，其后每列一个数组参数
+# total_weight_kg 列为 NUMERIC，以文本传入后再转换（连接层的 NUMERIC 编解码器只支持文本格式，无法使用 COPY）
+INSERT_MERGED_PARTS_SQL = f"""
+    INSERT INTO merged_parts (
+        merged_project_id, {', '.join(PART_FIELDS)}, created_at, updated_at
+    )
+    SELECT $1, {', '.join("NULLIF(p.total_weight_kg, '')::numeric" if field == 'total_weight_kg' else f"p.{field}" for field in PART_FIELDS)}, $2, $2
+    FROM unnest({', '.join(f"${i}::text[]" for i in range(3, len(PART_FIELDS) + 3))})
+        AS p({', '.join(PART_FIELDS)})
+"""
+
+# 每批写入的合并零部件行数
+MERGED_PARTS_INSERT_BATCH = 10_000
+
 
 # 合并多个项目的零部件API（通过项目名称）
 @app.post("/merge_parts")
 async def merge_parts(req: MergeRequest):
     """合并多个项目的零部件"""
+    if not req.project_names:
+        return JSONResponse(status_code=404, content={"error": "没有匹配的项目"})
     try:
         async with get_async_db_connection() as conn:
-            # 获取所有项目的零部件
-            all_parts = []
-            for project_name in req.project_names:
-                rows = await conn.fetch("""
-                    SELECT * FROM parts_library 
-                    WHERE project_name = $1 
-                    ORDER BY id
-                """, project_name)
-                
-                for row in rows:
-                    part_dict = dict(row)
-                    # 转换 Decimal 类型为 float
-                    for key, value in part_dict.items():
-                        if hasattr(value, '__float__'):
-                            part_dict[key] = float(value)
-                    all_parts.append(part_dict)
-            
-            return all_parts
+            # 一次查询获取所有项目的零部件，按请求中的项目顺序排列
+            rows = await conn.fetch("""
+                SELECT * FROM parts_library 
+                WHERE project_name = ANY($1::text[]) 
+                ORDER BY array_position($1::text[], project_name), id
+            """, req.project_names)
+        
+        if not rows:
+            return JSONResponse(status_code=404, content={"error": "没有匹配的项目"})
+        return [dict(row) for row in rows]
     except Exception as e:
         logger.error(f"合并零部件时出错: {str(e)}")
         return JSONResponse(status_code=500, content={"error": f"合并零部件时出错: {str(e)}"})
@@ -663,26 +693,20 @@ async def merge_parts(req: MergeRequest):
 @app.post("/merge_parts_by_file_ids")
 async def merge_parts_by_file_ids(req: MergeByFileIdsRequest):
     """合并多个文件项目的零部件"""
+    if not req.file_ids:
+        return JSONResponse(status_code=404, content={"error": "没有匹配的文件"})
     try:
         async with get_async_db_connection() as conn:
-            # 获取所有文件的零部件
-            all_parts = []
-            for file_unique_id in req.file_ids:
-                rows = await conn.fetch("""
-                    SELECT * FROM parts_library 
-                    WHERE file_unique_id = $1 
-                    ORDER BY id
-                """, file_unique_id)
-                
-                for row in rows:
-                    part_dict = dict(row)
-                    # 转换 Decimal 类型为 float
-                    for key, value in part_dict.items():
-                        if hasattr(value, '__float__'):
-                            part_dict[key] = float(value)
-                    all_parts.append(part_dict)
-            
-            return all_parts
+            # 一次查询获取所有文件的零部件，按请求中的文件顺序排列
+            rows = await conn.fetch("""
+                SELECT * FROM parts_library 
+                WHERE file_unique_id = ANY($1::text[]) 
+                ORDER BY array_position($1::text[], file_unique_id), id
+            """, req.file_ids)
+        
+        if not rows:
+            return JSONResponse(status_code=404, content={"error": "没有匹配的文件"})
+        return [dict(row) for row in rows]
     except Exception as e:
         logger.error(f"合并文件零部件时出错: {str(e)}")
         return JSONResponse(status_code=500, content={"error": f"合并文件零部件时出错: {str(e)}"})
@@ -691,34 +715,33 @@ async def merge_parts_by_file_ids(req: MergeByFileIdsRequest):
 @app.post("/update_parts")
 async def update_parts(req: UpdatePartsRequest):
     try:
+        # 只处理至少有一个待更新字段的零部件
+        parts = [part.dict() for part in req.parts]
+        parts = [part for part in parts if any(part[field] is not None for field in PART_FIELDS)]
+        if not parts:
+            return {"status": "success", "updated_count": 0}
+        
+        # 同一ID出现多次时按请求顺序合并，后出现的非空字段覆盖先前的值（与逐条更新的结果一致）；
+        # UPDATE ... FROM 中同一目标行匹配多条来源时只会任意应用其中一条
+        merged_parts = {}
+        for part in parts:
+            existing = merged_parts.get(part['id'])
+            if existing is None:
+                merged_parts[part['id']] = part
+            else:
+                existing.update({field: part[field] for field in PART_FIELDS if part[field] is not None})
+        parts = list(merged_parts.values())
+        
+        ids = [part['id'] for part in parts]
+        columns = [
+            [None if part[field] is None else str(part[field]) for part in parts]
+            for field in PART_FIELDS
+        ]
+        
         async with get_async_db_connection() as conn:
-            updated_count = 0
-            
-            for part in req.parts:
-                # 构建更新语句
-                update_fields = []
-                update_values = []
-                
-                # 动态构建更新字段和值
-                for field, value in part.dict(exclude={'id'}).items():
-                    if value is not None:  # 只更新非空字段
-                        update_fields.append(f"{field} = ${len(update_values) + 1}")
-                        update_values.append(value)
-                
-                if not update_fields:  # 如果没有要更新的字段，跳过
-                    continue
-                    
-                # 添加ID作为WHERE条件的值
-                update_values.append(part.id)
-                
-                # 构建并执行SQL语句
-                sql = f"""
-                    UPDATE parts_library 
-                    SET {', '.join(update_fields)}
-                    WHERE id = ${len(update_values)}
-                """
-                rowcount = await conn.execute(sql, *update_values)
-                updated_count += int(rowcount.split()[-1])  # 提取影响的行数
+            # 单条 UPDATE ... FROM unnest 一次更新所有零部件
+            result = await conn.execute(UPDATE_PARTS_SQL, ids, *columns)
+            updated_count = int(result.split()[-1])  # 提取影响的行数
             
             return {"status": "success", "updated_count": updated_count}
     except Exception as e:
@@ -736,42 +759,33 @@ async def save_merged_project(req: SaveMergedProjectRequest, current_user_data =
         user_info, token = current_user_data
         user_id = user_info['id']
         
+        now = datetime.now()
         async with get_async_db_connection() as conn:
-            # 插入合并项目记录，包含创建者信息
-            if req.source_file_ids:
-                merged_project_id = await conn.fetchval("""
-                    INSERT INTO merged_projects (merged_project_name, source_projects, source_file_ids, created_by, created_at, updated_at)
-                    VALUES ($1, $2, $3, $4, $5, $5)
-                    RETURNING id
-                """, req.merged_project_name, req.source_projects, req.source_file_ids, user_id, datetime.now())
-            else:
-                merged_project_id = await conn.fetchval("""
-                    INSERT INTO merged_projects (merged_project_name, source_projects, created_by, created_at, updated_at)
-                    VALUES ($1, $2, $3, $4, $4)
-                    RETURNING id
-                """, req.merged_project_name, req.source_projects, user_id, datetime.now())
+            # 合并项目记录与零部件记录在同一事务中写入
+            async with conn.transaction():
+                # 插入合并项目记录，包含创建者信息
+                if req.source_file_ids:
+                    merged_project_id = await conn.fetchval("""
+                        INSERT INTO merged_projects (merged_project_name, source_projects, source_file_ids, created_by, created_at, updated_at)
+                        VALUES ($1, $2, $3, $4, $5, $5)
+                        RETURNING id
+                    """, req.merged_project_name, req.source_projects, req.source_file_ids, user_id, now)
+                else:
+                    merged_project_id = await conn.fetchval("""
+                        INSERT INTO merged_projects (merged_project_name, source_projects, created_by, created_at, updated_at)
+                        VALUES ($1, $2, $3, $4, $4)
+                        RETURNING id
+                    """, req.merged_project_name, req.source_projects, user_id, now)
             
-            # 批量插入合并零部件记录
-            if req.parts:
-                values_list = []
-                for part in req.parts:
-                    values_list.append((
-                        merged_project_id, part.get('level'), part.get('part_code'), part.get('part_name'),
-                        part.get('spec'), part.get('version'), part.get('material'),
-                        part.get('unit_count_per_level'), part.get('unit_weight_kg'), part.get('total_weight_kg'),
-                        part.get('part_property'), part.get('drawing_size'), part.get('reference_number'),
-                        part.get('purchase_status'), part.get('process_route'), part.get('remark'),
-                        datetime.now(), datetime.now()
-                    ))
-                
-                await conn.executemany("""
-                    INSERT INTO merged_parts (
-                        merged_project_id, level, part_code, part_name, spec, version, material,
-                        unit_count_per_level, unit_weight_kg, total_weight_kg, part_property,
-                        drawing_size, reference_number, purchase_status, process_route, remark,
-                        created_at, updated_at
-                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18)
-                """, values_list)
+                # 批量插入合并零部件记录：每列作为一个数组参数，单条 INSERT ... SELECT unnest 写入一批
+                # 超大的零部件列表分批写入，限制单次构建的参数数组大小
+                for start in range(0, len(req.parts), MERGED_PARTS_INSERT_BATCH):
+                    batch = req.parts[start:start + MERGED_PARTS_INSERT_BATCH]
+                    columns = [
+                        [None if part.get(field) is None else str(part.get(field)) for part in batch]
+                        for field in PART_FIELDS
+                    ]
+                    await conn.execute(INSERT_MERGED_PARTS_SQL, merged_project_id, now, *columns)
             
             return {"status": "success", "merged_project_id": merged_project_id, "message": "合并项目保存成功"}
         
@@ -790,6 +804,37 @@ async def save_merged_project_with_hyphen(req: SaveMergedProjectRequest, current
 async def get_merged_projects_with_hyphen(current_user_data = Depends(get_current_user)):
     return await get_merged_projects(current_user_data)
 
+# 合并项目高频查询语句：语句文本固定，asyncpg 在每个连接的语句缓存中按文本复用预编译语句
+MERGED_PROJECTS_ADMIN_SQL = """
+    SELECT mp.id, mp.merged_project_name, mp.source_projects, mp.created_at, mp.created_by,
+           u.username as creator_name, u.full_name as creator_full_name
+    FROM merged_projects mp
+    LEFT JOIN users u ON mp.created_by = u.id
+    ORDER BY mp.created_at DESC
+"""
+
+MERGED_PROJECTS_BY_OWNER_SQL = """
+    SELECT mp.id, mp.merged_project_name, mp.source_projects, mp.created_at, mp.created_by,
+           u.username as creator_name, u.full_name as creator_full_name
+    FROM merged_projects mp
+    LEFT JOIN users u ON mp.created_by = u.id
+    WHERE mp.created_by = $1
+    ORDER BY mp.created_at DESC
+"""
+
+# $1 合并项目ID，$2 用户ID，$3 是否管理员；项目存在且有权限时至少返回一行（无部件时部件列为 NULL）
+MERGED_PROJECT_PARTS_SQL = """
+    WITH proj AS (
+        SELECT id FROM merged_projects
+        WHERE id = $1 AND ($3::boolean OR created_by = $2)
+    )
+    SELECT mp.id, mp.part_number, mp.part_name, mp.specification, mp.quantity,
+           mp.unit, mp.manufacturer, mp.material, mp.remarks, mp.file_id, mp.project_name
+    FROM proj p
+    LEFT JOIN merged_parts mp ON mp.merged_project_id = p.id
+    ORDER BY mp.part_number
+"""
+
 # 获取合并项目API
 # 获取合并项目列表API（异步实现）
 @app.get("/merged_projects")
@@ -803,36 +848,12 @@ async def get_merged_projects(current_user_data = Depends(get_current_user)):
         async with get_async_db_connection() as conn:
             # 管理员可以看到所有项目，普通用户只能看到自己创建的项目
             if user_role == 'admin':
-                rows = await conn.fetch("""
-                    SELECT mp.id, mp.merged_project_name, mp.source_projects, mp.created_at, mp.created_by,
-                           u.username as creator_name, u.full_name as creator_full_name
-                    FROM merged_projects mp
-                    LEFT JOIN users u ON mp.created_by = u.id
-                    ORDER BY mp.created_at DESC
-                """)
+                rows = await conn.fetch(MERGED_PROJECTS_ADMIN_SQL)
             else:
-                rows = await conn.fetch("""
-                    SELECT mp.id, mp.merged_project_name, mp.source_projects, mp.created_at, mp.created_by,
-                           u.username as creator_name, u.full_name as creator_full_name
-                    FROM merged_projects mp
-                    LEFT JOIN users u ON mp.created_by = u.id
-                    WHERE mp.created_by = $1
-                    ORDER BY mp.created_at DESC
-                """, user_id)
-        
-        result = []
-        for row in rows:
-            result.append({
-                "id": row['id'],
-                "merged_project_name": row['merged_project_name'],
-                "source_projects": row['source_projects'],
-                "created_at": row['created_at'].isoformat() if row['created_at'] else None,
-                "created_by": row['created_by'],
-                "creator_name": row['creator_name'],
-                "creator_full_name": row['creator_full_name']
-            })
+                rows = await conn.fetch(MERGED_PROJECTS_BY_OWNER_SQL, user_id)
         
-        return result
+        # 查询列名与返回字段一致，Record 直接转换为字典
+        return [dict(row) for row in rows]
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"获取合并项目时出错: {str(e)}"})
 
@@ -850,49 +871,24 @@ async def get_merged_project_parts(merged_project_id: int, current_user_data = D
         user_id = user_info['id']
         user_role = user_info['role']
         
+        # 缓存按用户区分，删除项目或部件时按 merged_project_parts: 前缀清除
+        cache_key = f"merged_project_parts:{merged_project_id}:{user_id}:{user_role}"
+        cached_parts = await cache_service.get(cache_key)
+        if cached_parts is not None:
+            return cached_parts
+        
         async with get_async_db_connection() as conn:
-            # 首先检查项目是否存在，以及用户是否有权限访问
-            if user_role == 'admin':
-                project_check = await conn.fetchrow("""
-                    SELECT mp.id, mp.merged_project_name, mp.created_by
-                    FROM merged_projects mp
-                    WHERE mp.id = $1
-                """, merged_project_id)
-            else:
-                project_check = await conn.fetchrow("""
-                    SELECT mp.id, mp.merged_project_name, mp.created_by
-                    FROM merged_projects mp
-                    WHERE mp.id = $1 AND mp.created_by = $2
-                """, merged_project_id, user_id)
-            
-            if not project_check:
-                return JSONResponse(status_code=404, content={"error": "合并项目未找到或无权限访问"})
-            
-            # 获取项目部件
-            rows = await conn.fetch("""
-                SELECT mp.id, mp.part_number, mp.part_name, mp.specification, mp.quantity, 
-                       mp.unit, mp.manufacturer, mp.material, mp.remarks, mp.file_id, mp.project_name
-                FROM merged_parts mp
-                WHERE mp.merged_project_id = $1
-                ORDER BY mp.part_number
-            """, merged_project_id)
+            # 一次查询同时完成权限检查和部件获取
+            rows = await conn.fetch(MERGED_PROJECT_PARTS_SQL, merged_project_id, user_id, user_role == 'admin')
+        
+        if not rows:
+            return JSONResponse(status_code=404, content={"error": "合并项目未找到或无权限访问"})
         
-        result = []
-        for row in rows:
-            result.append({
-                "id": row['id'],
-                "part_number": row['part_number'],
-                "part_name": row['part_name'],
-                "specification": row['specification'],
-                "quantity": row['quantity'],
-                "unit": row['unit'],
-                "manufacturer": row['manufacturer'],
-                "material": row['material'],
-                "remarks": row['remarks'],
-                "file_id": row['file_id'],
-                "project_name": row['project_name']
-            })
+        # 查询列名与返回字段一致，Record 直接转换为字典；跳过无部件项目的占位行
+        result = [dict(row) for row in rows if row['id'] is not None]
         
+        # 缓存合并项目部件（5分钟）
+        await cache_service.set(cache_key, result, expire=300)
         return result
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"获取合并项目部件时出错: {str(e)}"})
@@ -916,60 +912,38 @@ async def delete_merged_project(merged_project_id: int, current_user_data = Depe
         user_id = user_info['id']
         user_role = user_info['role']
         
-        logger.info(f"收到删除合并项目请求: merged_project_id={merged_project_id}, user_id={user_id}, user_role={user_role}")
-        
         async with get_async_db_connection() as conn:
-            # 首先检查项目是否存在，以及用户是否有权限删除
-            if user_role == 'admin':
-                project_check = await conn.fetchrow("""
-                    SELECT mp.id, mp.created_by
-                    FROM merged_projects mp
-                    WHERE mp.id = $1
-                """, merged_project_id)
-                logger.info(f"管理员删除检查: merged_project_id={merged_project_id}, project_check={project_check}")
-            else:
-                project_check = await conn.fetchrow("""
-                    SELECT mp.id, mp.created_by
-                    FROM merged_projects mp
-                    WHERE mp.id = $1 AND mp.created_by = $2
-                """, merged_project_id, user_id)
-                logger.info(f"普通用户删除检查: merged_project_id={merged_project_id}, user_id={user_id}, project_check={project_check}")
+            # 首先检查项目是否存在，以及用户是否有权限删除（管理员不限创建者）
+            project_check = await conn.fetchrow("""
+                SELECT mp.id, mp.created_by
+                FROM merged_projects mp
+                WHERE mp.id = $1 AND ($3::boolean OR mp.created_by = $2)
+            """, merged_project_id, user_id, user_role == 'admin')
             
             if not project_check:
-                logger.warning(f"合并项目未找到或无权限删除: merged_project_id={merged_project_id}, user_id={user_id}")
+                logger.warning("合并项目未找到或无权限删除: merged_project_id=%s, user_id=%s", merged_project_id, user_id)
                 return JSONResponse(status_code=404, content={"error": "合并项目未找到或无权限删除"})
             
-            # 开始事务
-            async with conn.transaction():
-                logger.info(f"开始删除合并项目的所有部件: merged_project_id={merged_project_id}")
-                # 先删除合并项目的所有部件
-                parts_result = await conn.execute("""
+            # 单条语句同时删除部件和合并项目（WITH 中的 DELETE 总会执行完毕，单条语句本身即原子操作）
+            result = await conn.execute("""
+                WITH deleted_parts AS (
                     DELETE FROM merged_parts
                     WHERE merged_project_id = $1
-                """, merged_project_id)
-                logger.info(f"删除部件结果: {parts_result}")
-                
-                logger.info(f"开始删除合并项目: merged_project_id={merged_project_id}")
-                # 然后删除合并项目
-                result = await conn.execute("""
-                    DELETE FROM merged_projects
-                    WHERE id = $1
-                """, merged_project_id)
-                
-                logger.info(f"删除项目结果: {result}")
-                if result == "DELETE 0":
-                    return JSONResponse(status_code=404, content={"error": "合并项目删除失败"})
+                )
+                DELETE FROM merged_projects
+                WHERE id = $1
+            """, merged_project_id)
+            
+            if result == "DELETE 0":
+                return JSONResponse(status_code=404, content={"error": "合并项目删除失败"})
         
-        # 清除相关缓存
-        logger.info(f"清除相关缓存: merged_project_id={merged_project_id}")
-        await cache_service.clear_pattern("merged_projects:*")
-        await cache_service.clear_pattern(f"merged_project_parts:{merged_project_id}:*")
+        # 并发清除相关缓存
+        await cache_service.invalidate_namespace(["merged_projects:*", f"merged_project_parts:{merged_project_id}:*"])
         
-        logger.info(f"合并项目删除成功: merged_project_id={merged_project_id}")
+        logger.info("合并项目删除成功: merged_project_id=%s, user_id=%s, user_role=%s", merged_project_id, user_id, user_role)
         return {"status": "success", "message": "合并项目及其部件删除成功"}
     except Exception as e:
-        logger.error(f"删除合并项目时出错: merged_project_id={merged_project_id}, error={str(e)}")
-        logger.error(f"错误详情: {type(e).__name__}: {str(e)}")
+        logger.error("删除合并项目时出错: merged_project_id=%s, %s: %s", merged_project_id, type(e).__name__, e)
         return JSONResponse(status_code=500, content={"error": f"删除合并项目时出错: {str(e)}"})
 
 # 删除合并项目中的零部件API
@@ -983,21 +957,13 @@ async def delete_merged_part(part_id: int, current_user_data = Depends(get_curre
         user_role = user_info['role']
         
         async with get_async_db_connection() as conn:
-            # 首先检查部件是否存在，以及用户是否有权限删除
-            if user_role == 'admin':
-                part_check = await conn.fetchrow("""
-                    SELECT mp.id, mp.merged_project_id, mp.part_number, mp.project_name
-                    FROM merged_parts mp
-                    JOIN merged_projects mpr ON mp.merged_project_id = mpr.id
-                    WHERE mp.id = $1
-                """, part_id)
-            else:
-                part_check = await conn.fetchrow("""
-                    SELECT mp.id, mp.merged_project_id, mp.part_number, mp.project_name
-                    FROM merged_parts mp
-                    JOIN merged_projects mpr ON mp.merged_project_id = mpr.id
-                    WHERE mp.id = $1 AND mpr.created_by = $2
-                """, part_id, user_id)
+            # 首先检查部件是否存在，以及用户是否有权限删除（管理员不限创建者）
+            part_check = await conn.fetchrow("""
+                SELECT mp.id, mp.merged_project_id, mp.part_number, mp.project_name
+                FROM merged_parts mp
+                JOIN merged_projects mpr ON mp.merged_project_id = mpr.id
+                WHERE mp.id = $1 AND ($3::boolean OR mpr.created_by = $2)
+            """, part_id, user_id, user_role == 'admin')
             
             if not part_check:
                 return JSONResponse(status_code=404, content={"error": "部件未找到或无权限删除"})
@@ -1018,6 +984,13 @@ async def delete_merged_part(part_id: int, current_user_data = Depends(get_curre
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"删除部件时出错: {str(e)}"})
 
+# 导出合并项目Excel的列与表头，一一对应
+EXPORT_MERGED_PROJECT_COLUMNS = (
+    "part_number", "part_name", "specification", "quantity", "unit",
+    "manufacturer", "material", "remarks", "project_name"
+)
+EXPORT_MERGED_PROJECT_HEADERS = ("物料编码", "物料名称", "规格", "数量", "单位", "制造商", "材质", "备注", "所属项目")
+
 # 导出合并项目为Excel API - 带连字符的路由（新增）
 @app.get("/export-merged-project/{merged_project_id}")
 def export_merged_project_with_hyphen(merged_project_id: int):
@@ -1033,19 +1006,12 @@ async def export_merged_project(merged_project_id: int, current_user_data = Depe
         user_role = user_info['role']
         
         async with get_async_db_connection() as conn:
-            # 首先检查项目是否存在，以及用户是否有权限访问
-            if user_role == 'admin':
-                project_check = await conn.fetchrow("""
-                    SELECT mp.id, mp.merged_project_name, mp.source_projects, mp.created_at
-                    FROM merged_projects mp
-                    WHERE mp.id = $1
-                """, merged_project_id)
-            else:
-                project_check = await conn.fetchrow("""
-                    SELECT mp.id, mp.merged_project_name, mp.source_projects, mp.created_at
-                    FROM merged_projects mp
-                    WHERE mp.id = $1 AND mp.created_by = $2
-                """, merged_project_id, user_id)
+            # 首先检查项目是否存在，以及用户是否有权限访问（管理员不限创建者）
+            project_check = await conn.fetchrow("""
+                SELECT mp.id, mp.merged_project_name, mp.source_projects, mp.created_at
+                FROM merged_projects mp
+                WHERE mp.id = $1 AND ($3::boolean OR mp.created_by = $2)
+            """, merged_project_id, user_id, user_role == 'admin')
             
             if not project_check:
                 return JSONResponse(status_code=404, content={"error": "合并项目未找到或无权限访问"})
@@ -1059,46 +1025,39 @@ async def export_merged_project(merged_project_id: int, current_user_data = Depe
                 ORDER BY mp.part_number
             """, merged_project_id)
         
-        # 创建Excel文件
-        df = pd.DataFrame([{
-            "物料编码": row['part_number'],
-            "物料名称": row['part_name'],
-            "规格": row['specification'],
-            "数量": row['quantity'],
-            "单位": row['unit'],
-            "制造商": row['manufacturer'],
-            "材质": row['material'],
-            "备注": row['remarks'],
-            "所属项目": row['project_name']
-        } for row in rows])
-        
-        # 创建内存中的Excel文件
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='物料清单', index=False)
-            
-            # 获取工作表并设置列宽
-            worksheet = writer.sheets['物料清单']
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
-        
-        output.seek(0)
-        
-        # 返回文件
+        # 直接用 openpyxl 只写模式生成Excel，单次遍历同时计算列宽
+        values = [tuple(row[column] for column in EXPORT_MERGED_PROJECT_COLUMNS) for row in rows]
+        widths = [len(header) for header in EXPORT_MERGED_PROJECT_HEADERS]
+        for value_row in values:
+            for i, value in enumerate(value_row):
+                if value is not None and len(str(value)) > widths[i]:
+                    widths[i] = len(str(value))
+        
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('物料清单')
+        # 只写模式下列宽须在写入行之前设置
+        for i, width in enumerate(widths):
+            worksheet.column_dimensions[get_column_letter(i + 1)].width = min(width + 2, 50)
+        worksheet.append(EXPORT_MERGED_PROJECT_HEADERS)
+        for value_row in values:
+            worksheet.append(value_row)
+        
+        # 保存到临时文件后由 FileResponse 直接从磁盘分块发送，发送完毕后删除临时文件
+        with NamedTemporaryFile(suffix='.xlsx', delete=False) as tmp:
+            export_path = tmp.name
+        try:
+            workbook.save(export_path)
+        except Exception:
+            os.unlink(export_path)
+            raise
+        
+        # 返回文件（FileResponse 会对中文文件名做 URL 编码）
         filename = f"{project_check['merged_project_name']}_物料清单.xlsx"
-        return StreamingResponse(
-            io.BytesIO(output.getvalue()),
+        return FileResponse(
+            export_path,
             media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+            filename=filename,
+            background=BackgroundTask(os.unlink, export_path)
         )
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"导出合并项目时出错: {str(e)}"})
@@ -1133,31 +1092,24 @@ async def delete_project(project_name: str, current_user_data = Depends(get_curr
             if not project_check:
                 return JSONResponse(status_code=404, content={"error": "项目未找到或无权限删除"})
             
-            # 开始事务
-            async with conn.transaction():
-                # 删除项目部件
-                await conn.execute("""
+            # 单条语句删除项目部件、项目笔记和上传文件记录，一次往返完成且本身即原子操作
+            await conn.execute("""
+                WITH deleted_parts AS (
                     DELETE FROM parts_library
                     WHERE project_name = $1
-                """, project_name)
-                
-                # 删除项目相关笔记
-                await conn.execute("""
+                ), deleted_notes AS (
                     DELETE FROM project_notes
                     WHERE project_name = $1
-                """, project_name)
-                
-                # 删除上传文件记录
-                await conn.execute("""
-                    DELETE FROM uploaded_files
-                    WHERE project_name = $1
-                """, project_name)
+                )
+                DELETE FROM uploaded_files
+                WHERE project_name = $1
+            """, project_name)
         
-        # 清除相关缓存
-        await cache_service.clear_pattern("projects:*")
-        await cache_service.clear_pattern("parts:*")
-        await cache_service.clear_pattern("file_mappings:*")
-        await cache_service.clear_pattern("uploaded_files:*")
+        # 并发清除相关缓存
+        await asyncio.gather(
+            cache_service.invalidate_namespace(["projects:*", "parts:*", "file_mappings:*"]),
+            cache_service.invalidate_tag("uploaded_files")
+        )
         
         return {"status": "success", "message": f"项目 '{project_name}' 及其所有相关数据删除成功"}
     except Exception as e:
@@ -1190,35 +1142,27 @@ async def delete_project_by_file_id(file_unique_id: str, current_user_data = Dep
             project_name = file_info['project_name']
             category_id = file_info['category_id']
             
-            # 开始事务
-            async with conn.transaction():
-                # 删除parts_library表中对应文件ID的所有记录
-                await conn.execute("""
+            # 单条语句删除该文件的零部件、上传文件记录和项目笔记，一次往返完成且本身即原子操作
+            await conn.execute("""
+                WITH deleted_parts AS (
                     DELETE FROM parts_library
                     WHERE file_unique_id = $1
-                """, file_unique_id)
-                
-                # 删除uploaded_files表中的记录
-                await conn.execute("""
+                ), deleted_files AS (
                     DELETE FROM uploaded_files
                     WHERE file_unique_id = $1
-                """, file_unique_id)
-                
-                # 删除project_notes表中的记录
-                await conn.execute("""
-                    DELETE FROM project_notes
-                    WHERE project_name = $1
-                """, project_name)
-        
-        # 清理相关缓存
-        await cache_service.clear_pattern("uploaded_files:*")
-        await cache_service.clear_pattern("projects:*")
-        await cache_service.clear_pattern("parts:*")
-        await cache_service.clear_pattern("file_mappings:*")
+                )
+                DELETE FROM project_notes
+                WHERE project_name = $2
+            """, file_unique_id, project_name)
         
-        # 如果有分类，清理分类相关缓存
+        # 并发清理相关缓存；如果有分类，同时清理分类相关缓存
+        patterns = ["projects:*", "parts:*", "file_mappings:*"]
         if category_id:
-            await cache_service.clear_pattern(f"projects_by_category:{category_id}")
+            patterns.append(f"projects_by_category:{category_id}")
+        await asyncio.gather(
+            cache_service.invalidate_namespace(patterns),
+            cache_service.invalidate_tag("uploaded_files")
+        )
         
         return {"status": "success", "message": "项目删除成功"}
     except Exception as e:
@@ -1233,8 +1177,7 @@ async def get_categories():
         categories = await get_all_categories_async()
         return categories
     except Exception as e:
-        error_detail = f"获取分类列表失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        logger.error(error_detail)
+        logger.error("获取分类列表失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"获取分类列表失败: {str(e)}"})
 
 # 获取用户有权限的分类
@@ -1246,8 +1189,9 @@ async def get_user_categories(current_user_data = Depends(get_current_user)):
         user_id = user_info['id']
         user_role = user_info['role']
         
-        # 构建缓存键
-        cache_key = f"user_categories:{user_id}:{user_role}"
+        # 构建缓存键：带上分类缓存版本号，分类增删改时递增版本号即可使所有用户的旧缓存失效
+        version = await cache_service.get_version("user_categories")
+        cache_key = f"user_categories:{user_id}:{user_role}:v{version}"
         
         # 尝试从缓存获取分类列表
         cached_categories = await cache_service.get(cache_key)
@@ -1271,16 +1215,8 @@ async def get_user_categories(current_user_data = Depends(get_current_user)):
                     ORDER BY c.created_at ASC
                 """, user_id)
                 
-                categories = []
-                for row in rows:
-                    categories.append({
-                        'id': row['id'],
-                        'name': row['name'],
-                        'description': row['description'],
-                        'color': row['color'],
-                        'created_at': row['created_at'].isoformat() if row['created_at'] else None,
-                        'updated_at': row['updated_at'].isoformat() if row['updated_at'] else None
-                    })
+                # 查询列名与返回字段一致，Record 直接转换为字典
+                categories = [dict(row) for row in rows]
         
         # 缓存分类列表（5分钟，因为权限可能变化较频繁）
         await cache_service.set(cache_key, categories, expire=300)
@@ -1301,10 +1237,16 @@ async def get_category(category_id: int):
             return JSONResponse(status_code=404, content={"error": f"未找到ID为 {category_id} 的分类"})
         return category
     except Exception as e:
-        error_detail = f"获取分类失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        logger.error(error_detail)
+        logger.error("获取分类失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"获取分类失败: {str(e)}"})
 
+async def invalidate_category_caches(category_id: int):
+    """分类变更后使所有用户的分类列表缓存失效（递增版本号），并清除该分类的权限缓存"""
+    await asyncio.gather(
+        cache_service.bump_version("user_categories"),
+        cache_service.clear_pattern(f"permission:*:category:{category_id}:*")
+    )
+
 # 创建新分类
 @app.post("/categories")
 async def create_category(request: Request):
@@ -1324,34 +1266,9 @@ async def create_category(request: Request):
     try:
         category = await create_category_async(name, description, color)
         
-        # 清理分类相关缓存
+        # 清理所有用户的分类缓存和该分类相关的权限缓存
         try:
-            # 清理所有用户的分类缓存
-            if cache_service.redis_client:
-                # 获取所有用户分类缓存键
-                cache_keys = await cache_service.redis_client.keys("user_categories:*")
-                if cache_keys:
-                    await cache_service.redis_client.delete(*cache_keys)
-                    logger.info(f"清理了 {len(cache_keys)} 个用户分类缓存")
-                
-                # 清理该分类相关的权限缓存
-                permission_cache_keys = await cache_service.redis_client.keys(f"permission:*:category:{category_id}:*")
-                if permission_cache_keys:
-                    await cache_service.redis_client.delete(*permission_cache_keys)
-                    logger.info(f"清理了 {len(permission_cache_keys)} 个分类 {category_id} 的权限缓存")
-            else:
-                # 内存缓存清理
-                keys_to_delete = [key for key in cache_service._memory_cache.keys() if key.startswith("user_categories:")]
-                for key in keys_to_delete:
-                    del cache_service._memory_cache[key]
-                logger.info(f"清理了 {len(keys_to_delete)} 个内存分类缓存")
-                
-                # 清理权限缓存
-                permission_keys_to_delete = [key for key in cache_service._memory_cache.keys() 
-                                           if key.startswith("permission:") and f":category:{category_id}:" in key]
-                for key in permission_keys_to_delete:
-                    del cache_service._memory_cache[key]
-                logger.info(f"清理了 {len(permission_keys_to_delete)} 个内存权限缓存")
+            await invalidate_category_caches(category['id'])
         except Exception as cache_error:
             logger.warning(f"清理分类缓存失败: {cache_error}")
         
@@ -1359,8 +1276,7 @@ async def create_category(request: Request):
     except ValueError as e:
         return JSONResponse(status_code=400, content={"error": str(e)})
     except Exception as e:
-        error_detail = f"创建分类失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        logger.error(error_detail)
+        logger.error("创建分类失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"创建分类失败: {str(e)}"})
 
 # 更新分类
@@ -1376,21 +1292,9 @@ async def update_category(
         if not category:
             return JSONResponse(status_code=404, content={"error": f"未找到ID为 {category_id} 的分类"})
         
-        # 清理分类相关缓存
+        # 清理所有用户的分类缓存和该分类相关的权限缓存
         try:
-            # 清理所有用户的分类缓存
-            if cache_service.redis_client:
-                # 获取所有用户分类缓存键
-                cache_keys = await cache_service.redis_client.keys("user_categories:*")
-                if cache_keys:
-                    await cache_service.redis_client.delete(*cache_keys)
-                    logger.info(f"清理了 {len(cache_keys)} 个用户分类缓存")
-            else:
-                # 内存缓存清理
-                keys_to_delete = [key for key in cache_service._memory_cache.keys() if key.startswith("user_categories:")]
-                for key in keys_to_delete:
-                    del cache_service._memory_cache[key]
-                logger.info(f"清理了 {len(keys_to_delete)} 个内存分类缓存")
+            await invalidate_category_caches(category_id)
         except Exception as cache_error:
             logger.warning(f"清理分类缓存失败: {cache_error}")
         
@@ -1398,8 +1302,7 @@ async def update_category(
     except ValueError as e:
         return JSONResponse(status_code=400, content={"error": str(e)})
     except Exception as e:
-        error_detail = f"更新分类失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        logger.error(error_detail)
+        logger.error("更新分类失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"更新分类失败: {str(e)}"})
 
 # 删除分类
@@ -1410,21 +1313,9 @@ async def delete_category(category_id: int):
         if not success:
             return JSONResponse(status_code=404, content={"error": f"未找到ID为 {category_id} 的分类"})
         
-        # 清理分类相关缓存
+        # 清理所有用户的分类缓存和该分类相关的权限缓存
         try:
-            # 清理所有用户的分类缓存
-            if cache_service.redis_client:
-                # 获取所有用户分类缓存键
-                cache_keys = await cache_service.redis_client.keys("user_categories:*")
-                if cache_keys:
-                    await cache_service.redis_client.delete(*cache_keys)
-                    logger.info(f"清理了 {len(cache_keys)} 个用户分类缓存")
-            else:
-                # 内存缓存清理
-                keys_to_delete = [key for key in cache_service._memory_cache.keys() if key.startswith("user_categories:")]
-                for key in keys_to_delete:
-                    del cache_service._memory_cache[key]
-                logger.info(f"清理了 {len(keys_to_delete)} 个内存分类缓存")
+            await invalidate_category_caches(category_id)
         except Exception as cache_error:
             logger.warning(f"清理分类缓存失败: {cache_error}")
         
@@ -1432,8 +1323,7 @@ async def delete_category(category_id: int):
     except ValueError as e:
         return JSONResponse(status_code=400, content={"error": str(e)})
     except Exception as e:
-        error_detail = f"删除分类失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        logger.error(error_detail)
+        logger.error("删除分类失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"删除分类失败: {str(e)}"})
 
 # 将项目分配到分类
@@ -1447,8 +1337,7 @@ async def assign_project_category(
         result = await assign_project_to_category_async(project_name, file_unique_id, category_id)
         return {"status": "success", "message": "项目分类分配成功", "assignment": result}
     except Exception as e:
-        error_detail = f"分配项目分类失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        logger.error(error_detail)
+        logger.error("分配项目分类失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"分配项目分类失败: {str(e)}"})
 
 # 获取指定分类下的所有项目
@@ -1458,8 +1347,7 @@ async def get_category_projects(category_id: int):
         projects = await get_projects_by_category_async(category_id)
         return projects
     except Exception as e:
-        error_detail = f"获取分类项目失败: {str(e)}\n详细信息: {traceback.format_exc()}"
-        logger.error(error_detail)
+        logger.error("获取分类项目失败: %s", e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"获取分类项目失败: {str(e)}"})
 
 # 连接池健康检查和监控API
@@ -1515,5 +1403,9 @@ async def check_async_db_pool_health():
 if __name__ == "__main__":
     import uvicorn
     import time
-    # Docker环境中使用单进程，通过容器编排实现多实例
-    uvicorn.run("main:app", host="0.0.0.0", port=8596)
+    # Docker环境中默认单进程，通过容器编排实现多实例；需要多进程时通过 WEB_CONCURRENCY 指定
+    # 使用 uvloop 事件循环和 httptools 解析器提升吞吐量
+    uvicorn.run(
+        "main:app", host="0.0.0.0", port=8596, loop="uvloop", http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", 1))
+    )
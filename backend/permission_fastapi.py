@@ -139,7 +139,7 @@ def create_permission_routes(app: FastAPI):
                 # 缓存清理失败不影响权限授予操作的成功
             
             # 记录操作日志
-            auth_service.log_user_activity(
+            auth_service.enqueue_user_activity(
                 user_info['id'],
                 'grant_permission',
                 'permission',
@@ -155,7 +155,7 @@ def create_permission_routes(app: FastAPI):
             
         except HTTPException:
             raise
-        except psycopg2.Error as e:
+        except asyncpg.Error as e:
             logger.error(f"Grant permission error: {e}")
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -215,7 +215,7 @@ def create_permission_routes(app: FastAPI):
                 # 缓存清理失败不影响权限撤销操作的成功
             
             # 记录操作日志
-            auth_service.log_user_activity(
+            auth_service.enqueue_user_activity(
                 user_info['id'],
                 'revoke_permission',
                 'permission',
@@ -230,7 +230,7 @@ def create_permission_routes(app: FastAPI):
             
         except HTTPException:
             raise
-        except psycopg2.Error as e:
+        except asyncpg.Error as e:
             logger.error(f"Revoke permission error: {e}")
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -2,6 +2,18 @@
 # 用于BOM合并项目的Redis连接配置
 
 import os
+import socket
+
+# TCP保活参数（Linux），尽早发现被NAT/防火墙断开的连接
+_KEEPALIVE_OPTIONS = {
+    option: value
+    for option, value in (
+        (getattr(socket, 'TCP_KEEPIDLE', None), 60),
+        (getattr(socket, 'TCP_KEEPINTVL', None), 10),
+        (getattr(socket, 'TCP_KEEPCNT', None), 3),
+    )
+    if option is not None
+}
 
 # Redis连接配置
 REDIS_CONFIG = {
@@ -12,11 +24,17 @@ REDIS_CONFIG = {
     'decode_responses': True,
     'socket_connect_timeout': 5,
     'socket_timeout': 5,
+    'socket_keepalive': True,
+    'socket_keepalive_options': _KEEPALIVE_OPTIONS,
     'retry_on_timeout': True,
     'retry_on_error': [ConnectionError, TimeoutError],
     'health_check_interval': 30
 }
 
+# Redis连接池上限：连接用尽时最多等待 REDIS_POOL_TIMEOUT 秒，而不是在高峰期无限新建连接
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = 2
+
 # 缓存过期时间配置（秒）
 CACHE_EXPIRY = {
     'session': 3600,        # 用户会话缓存 1小时
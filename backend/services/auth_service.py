@@ -1,7 +1,13 @@
+import asyncio
 import hashlib
+import os
+import time
 import jwt
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, Tuple
+import orjson
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional, Dict, Any, Tuple, Union
 import bcrypt
 import logging
 from db import get_async_db_connection
@@ -11,31 +17,103 @@ import asyncpg
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# bcrypt 计算成本（2^cost 轮），可通过环境变量调整
+BCRYPT_COST = int(os.getenv('BCRYPT_COST', 12))
+# bcrypt 哈希在专用线程池中执行：bcrypt 计算期间释放GIL，多核可并行，且不阻塞事件循环
+_BCRYPT_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='bcrypt')
+
+# 注册与登录使用的语句（模块级常量，保证文本一致以命中asyncpg的预编译语句缓存）
+# 用户名/邮箱查找拆成 UNION ALL 的两条子查询，各自走 username、email 的唯一索引，避免 OR 条件退化为 BitmapOr 或顺序扫描
+SELECT_EXISTING_USER_SQL = (
+    "(SELECT id FROM users WHERE username = $1 LIMIT 1) "
+    "UNION ALL (SELECT id FROM users WHERE email = $2 LIMIT 1) LIMIT 1"
+)
+INSERT_USER_SQL = "INSERT INTO users (username, email, password_hash, full_name) VALUES ($1, $2, $3, $4) RETURNING id"
+# 密码哈希以 bytea 取回，asyncpg 直接解码为 bytes，校验时无需再编码
+SELECT_LOGIN_USER_COLUMNS = "id, username, email, convert_to(password_hash, 'UTF8') AS password_hash, full_name, role, is_active"
+SELECT_LOGIN_USER_SQL = (
+    f"(SELECT {SELECT_LOGIN_USER_COLUMNS} FROM users WHERE username = $1 LIMIT 1) "
+    f"UNION ALL (SELECT {SELECT_LOGIN_USER_COLUMNS} FROM users WHERE email = $1 LIMIT 1) LIMIT 1"
+)
+
+# 用户活动日志写入语句
+INSERT_ACTIVITY_LOG_SQL = (
+    "INSERT INTO user_activity_logs (user_id, action, resource_type, resource_id, details, ip_address, user_agent) "
+    "VALUES ($1, $2, $3, $4, $5, $6, $7)"
+)
+
+# 登录成功：更新最后登录时间并写入活动日志（参数与 INSERT_ACTIVITY_LOG_SQL 相同，$1 为用户ID）
+LOGIN_SUCCESS_SQL = f"""
+    WITH updated AS (
+        UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = $1
+    )
+    {INSERT_ACTIVITY_LOG_SQL}
+"""
+
+# 用户活动日志异步批量写入：请求路径只把日志放入有界队列，由后台任务按批 COPY 写入
+ACTIVITY_LOG_QUEUE_MAX_SIZE = 10000
+ACTIVITY_LOG_BATCH_SIZE = 500
+ACTIVITY_LOG_COLUMNS = ('user_id', 'action', 'resource_type', 'resource_id', 'details', 'ip_address', 'user_agent')
+# 后台写入任务的停止标记（应用关闭时放入队列）
+_ACTIVITY_LOG_STOP = object()
+
+# 常见活动日志详情（登录失败原因）的预序列化JSON，避免每次记录都重新序列化
+_COMMON_DETAILS_JSON = {
+    reason: orjson.dumps({'reason': reason}).decode()
+    for reason in ('user_not_found', 'invalid_password', 'account_disabled')
+}
+
+# 已验证JWT的进程内缓存容量：键为 blake2b(token) 16字节摘要，值为 (缓存过期时间, payload)，按LRU淘汰
+JWT_CACHE_MAX_SIZE = 10000
+# 缓存条目的最长保留时间：即使令牌有效期更长，也至少每小时重新校验一次签名
+JWT_CACHE_MAX_TTL = 3600
+
+def _token_fingerprint(token: str) -> str:
+    """计算令牌指纹（16位十六进制），仅用于派生缓存键；令牌本身已由JWT签名认证，无需加密强度更高的哈希"""
+    return hashlib.blake2b(token.encode(), digest_size=8).hexdigest()
+
+def _legacy_token_fingerprint(token: str) -> str:
+    """旧版令牌指纹 sha256(token) 前16位十六进制，改用 blake2b 之前登录的会话键仍使用它
+    
+    过渡期内登出时同时删除新旧两个会话键；部署超过一个会话有效期（24小时）后可删除此函数。
+    """
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
 class AuthService:
     def __init__(self):
         # JWT配置 - 在生产环境中应该使用环境变量
         self.jwt_secret = "your-secret-key-change-in-production"
         self.jwt_algorithm = "HS256"
         self.token_expire_hours = 24
+        self._token_expire_seconds = self.token_expire_hours * 3600
+        self._jwt_cache: OrderedDict = OrderedDict()
+        self._activity_log_queue: Optional[asyncio.Queue] = None
+        self._activity_log_task: Optional[asyncio.Task] = None
     
-    def hash_password(self, password: str) -> str:
-        """对密码进行哈希处理"""
-        salt = bcrypt.gensalt()
-        hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
+    async def hash_password(self, password: str) -> str:
+        """对密码进行哈希处理（在bcrypt线程池中执行）"""
+        salt = bcrypt.gensalt(rounds=BCRYPT_COST)
+        loop = asyncio.get_running_loop()
+        hashed = await loop.run_in_executor(_BCRYPT_EXECUTOR, bcrypt.hashpw, password.encode('utf-8'), salt)
         return hashed.decode('utf-8')
     
-    def verify_password(self, password: str, hashed: str) -> bool:
-        """验证密码"""
-        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    async def verify_password(self, password: str, hashed: Union[str, bytes]) -> bool:
+        """验证密码（在bcrypt线程池中执行），hashed 可直接传入登录查询取回的 bytes"""
+        if isinstance(hashed, str):
+            hashed = hashed.encode('utf-8')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_BCRYPT_EXECUTOR, bcrypt.checkpw, password.encode('utf-8'), hashed)
     
     def generate_jwt_token(self, user_id: int, username: str, role: str, email: str = None, full_name: str = None) -> str:
         """生成JWT令牌"""
+        # exp/iat 直接使用整数时间戳，与 PyJWT 编码后的格式一致
+        now = int(time.time())
         payload = {
             'user_id': user_id,
             'username': username,
             'role': role,
-            'exp': datetime.utcnow() + timedelta(hours=self.token_expire_hours),
-            'iat': datetime.utcnow()
+            'exp': now + self._token_expire_seconds,
+            'iat': now
         }
         
         # 如果提供了email和full_name，添加到payload中
@@ -47,9 +125,20 @@ class AuthService:
         return jwt.encode(payload, self.jwt_secret, algorithm=self.jwt_algorithm)
     
     def verify_jwt_token(self, token: str) -> Optional[Dict[str, Any]]:
-        """验证JWT令牌"""
+        """验证JWT令牌（验证通过的令牌缓存至过期，重复验证只需一次字典查找）"""
+        cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        cached = self._jwt_cache.get(cache_key)
+        if cached is not None:
+            if cached[0] > time.time():
+                self._jwt_cache.move_to_end(cache_key)
+                return cached[1]
+            del self._jwt_cache[cache_key]
+        
         try:
             payload = jwt.decode(token, self.jwt_secret, algorithms=[self.jwt_algorithm])
+            self._jwt_cache[cache_key] = (min(payload['exp'], time.time() + JWT_CACHE_MAX_TTL), payload)
+            if len(self._jwt_cache) > JWT_CACHE_MAX_SIZE:
+                self._jwt_cache.popitem(last=False)
             return payload
         except jwt.ExpiredSignatureError:
             logger.warning("JWT token has expired")
@@ -77,19 +166,13 @@ class AuthService:
         try:
             async with get_async_db_connection() as conn:
                 # 检查用户名和邮箱是否已存在
-                existing_user = await conn.fetchrow(
-                    "SELECT id FROM users WHERE username = $1 OR email = $2",
-                    username, email
-                )
+                existing_user = await conn.fetchrow(SELECT_EXISTING_USER_SQL, username, email)
                 if existing_user:
                     return False, "用户名或邮箱已存在", None
                 
                 # 创建新用户
-                password_hash = self.hash_password(password)
-                user_id = await conn.fetchval(
-                    "INSERT INTO users (username, email, password_hash, full_name) VALUES ($1, $2, $3, $4) RETURNING id",
-                    username, email, password_hash, full_name
-                )
+                password_hash = await self.hash_password(password)
+                user_id = await conn.fetchval(INSERT_USER_SQL, username, email, password_hash, full_name)
                 
                 logger.info(f"User registered successfully: {username}")
                 return True, "注册成功", user_id
@@ -104,71 +187,61 @@ class AuthService:
     async def login_user_async(self, username: str, password: str, ip_address: str = None, user_agent: str = None) -> Tuple[bool, str, Optional[Dict[str, Any]]]:
         """异步用户登录（Redis会话管理）"""
         try:
+            # 查找用户：只在查询期间占用连接，密码校验（bcrypt）期间不持有连接
             async with get_async_db_connection() as conn:
-                # 查找用户
-                user = await conn.fetchrow(
-                    "SELECT id, username, email, password_hash, full_name, role, is_active FROM users WHERE username = $1 OR email = $2",
-                    username, username
-                )
-                
-                if not user:
-                    # 记录登录失败日志
-                    await self.log_user_activity_async(None, 'login_failed', 'user', username, {'reason': 'user_not_found'}, ip_address, user_agent)
-                    return False, "用户不存在", None
-                
-                if not user['is_active']:
-                    # 记录登录失败日志
-                    await self.log_user_activity_async(user['id'], 'login_failed', 'user', str(user['id']), {'reason': 'account_disabled'}, ip_address, user_agent)
-                    return False, "账户已被禁用", None
-                
-                # 验证密码
-                if not self.verify_password(password, user['password_hash']):
-                    # 记录登录失败日志
-                    await self.log_user_activity_async(user['id'], 'login_failed', 'user', str(user['id']), {'reason': 'invalid_password'}, ip_address, user_agent)
-                    return False, "密码错误", None
-                
-                # 生成JWT令牌
-                token = self.generate_jwt_token(user['id'], user['username'], user['role'], user['email'], user['full_name'])
-                
-                # 将会话信息保存到Redis
-                session_data = {
-                    'id': user['id'],
-                    'username': user['username'],
-                    'email': user['email'],
-                    'full_name': user['full_name'],
-                    'role': user['role'],
-                    'login_time': datetime.utcnow().isoformat(),
-                    'is_active': user['is_active']
-                }
-                
-                # 使用token的hash作为Redis键的一部分
-                token_hash = hashlib.sha256(token.encode()).hexdigest()
-                cache_key = f"bom:session:{user['id']}:{token_hash[:16]}"
-                
-                # 设置会话缓存，过期时间与JWT一致
-                await cache_service.set(cache_key, session_data, expire=self.token_expire_hours * 3600)
-                
-                # 更新最后登录时间
-                await conn.execute(
-                    "UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = $1",
-                    user['id']
-                )
-                
-                # 记录登录成功日志
-                await self.log_user_activity_async(user['id'], 'login', 'user', str(user['id']), {'ip_address': ip_address}, ip_address, user_agent)
-                
-                user_info = {
-                    'id': user['id'],
-                    'username': user['username'],
-                    'email': user['email'],
-                    'full_name': user['full_name'],
-                    'role': user['role'],
-                    'token': token
-                }
-                
-                logger.info(f"User logged in successfully: {username}")
-                return True, "登录成功", user_info
-                
+                user = await conn.fetchrow(SELECT_LOGIN_USER_SQL, username)
+            
+            if not user:
+                # 记录登录失败日志
+                self.enqueue_user_activity(None, 'login_failed', 'user', username, {'reason': 'user_not_found'}, ip_address, user_agent)
+                return False, "用户不存在", None
+            
+            if not user['is_active']:
+                # 记录登录失败日志
+                self.enqueue_user_activity(user['id'], 'login_failed', 'user', str(user['id']), {'reason': 'account_disabled'}, ip_address, user_agent)
+                return False, "账户已被禁用", None
+            
+            # 验证密码
+            if not await self.verify_password(password, user['password_hash']):
+                # 记录登录失败日志
+                self.enqueue_user_activity(user['id'], 'login_failed', 'user', str(user['id']), {'reason': 'invalid_password'}, ip_address, user_agent)
+                return False, "密码错误", None
+            
+            # 生成JWT令牌
+            token = self.generate_jwt_token(user['id'], user['username'], user['role'], user['email'], user['full_name'])
+            
+            # 将会话信息保存到Redis
+            session_data = {
+                'id': user['id'],
+                'username': user['username'],
+                'email': user['email'],
+                'full_name': user['full_name'],
+                'role': user['role'],
+                'login_time': datetime.utcnow().isoformat(),
+                'is_active': user['is_active']
+            }
+            
+            # 使用token的指纹作为Redis键的一部分
+            cache_key = f"bom:session:{user['id']}:{_token_fingerprint(token)}"
+            
+            # 设置会话缓存（过期时间与JWT一致，SETEX 一次往返）与记录登录并发进行，不再依次等待Redis和PostgreSQL
+            await asyncio.gather(
+                cache_service.set(cache_key, session_data, expire=self._token_expire_seconds),
+                self._record_login(user['id'], ip_address, user_agent)
+            )
+            
+            user_info = {
+                'id': user['id'],
+                'username': user['username'],
+                'email': user['email'],
+                'full_name': user['full_name'],
+                'role': user['role'],
+                'token': token
+            }
+            
+            logger.info(f"User logged in successfully: {username}")
+            return True, "登录成功", user_info
+            
         except asyncpg.PostgresError as e:
             logger.error(f"Database error during login: {e}")
             return False, "登录失败，请稍后重试", None
@@ -176,6 +249,17 @@ class AuthService:
             logger.error(f"Unexpected error during login: {e}")
             return False, "登录失败，请稍后重试", None
     
+    async def _record_login(self, user_id: int, ip_address: str = None, user_agent: str = None):
+        """更新最后登录时间并记录登录成功日志，一条语句一次往返完成；失败不影响登录"""
+        try:
+            async with get_async_db_connection() as conn:
+                await conn.execute(
+                    LOGIN_SUCCESS_SQL,
+                    user_id, 'login', 'user', str(user_id), orjson.dumps({'ip_address': ip_address}).decode(), ip_address, user_agent
+                )
+        except Exception as e:
+            logger.error(f"Error recording login: {e}")
+    
     async def logout_user_async(self, token: str, ip_address: str = None, user_agent: str = None) -> Tuple[bool, str]:
         """异步用户登出（纯Redis实现）"""
         try:
@@ -186,14 +270,15 @@ class AuthService:
             
             user_id = payload['user_id']
             username = payload['username']
-            token_hash = hashlib.sha256(token.encode()).hexdigest()
             
-            # 删除Redis中的会话
-            cache_key = f"bom:session:{user_id}:{token_hash[:16]}"
-            await cache_service.delete(cache_key)
+            # 删除Redis中的会话（过渡期内同时删除旧版指纹的会话键）
+            await asyncio.gather(
+                cache_service.delete(f"bom:session:{user_id}:{_token_fingerprint(token)}"),
+                cache_service.delete(f"bom:session:{user_id}:{_legacy_token_fingerprint(token)}")
+            )
             
             # 记录登出日志
-            await self.log_user_activity_async(user_id, 'logout', 'user', str(user_id), {'ip_address': ip_address}, ip_address, user_agent)
+            self.enqueue_user_activity(user_id, 'logout', 'user', str(user_id), {'ip_address': ip_address}, ip_address, user_agent)
             
             logger.info(f"User logged out successfully: {username}")
             return True, "登出成功"
@@ -202,21 +287,88 @@ class AuthService:
             logger.error(f"Logout error: {e}")
             return False, "登出失败"
     
+    def enqueue_user_activity(self, user_id: int, action: str, resource_type: str = None, resource_id: str = None, details: Dict = None, ip_address: str = None, user_agent: str = None):
+        """记录用户活动日志（不等待写入）：放入队列后立即返回，由后台任务批量写入数据库"""
+        if self._activity_log_queue is None:
+            self._activity_log_queue = asyncio.Queue(maxsize=ACTIVITY_LOG_QUEUE_MAX_SIZE)
+        if self._activity_log_task is None or self._activity_log_task.done():
+            self._activity_log_task = asyncio.create_task(self._drain_activity_logs())
+        
+        # 将字典转换为JSON字符串；常见的登录失败原因直接使用预先序列化的结果
+        if not details:
+            details_json = None
+        elif len(details) == 1 and details.get('reason') in _COMMON_DETAILS_JSON:
+            details_json = _COMMON_DETAILS_JSON[details['reason']]
+        else:
+            details_json = orjson.dumps(details).decode()
+        try:
+            self._activity_log_queue.put_nowait((user_id, action, resource_type, resource_id, details_json, ip_address, user_agent))
+        except asyncio.QueueFull:
+            logger.warning(f"User activity log queue is full, dropping log: {action}")
+    
     async def log_user_activity_async(self, user_id: int, action: str, resource_type: str = None, resource_id: str = None, details: Dict = None, ip_address: str = None, user_agent: str = None):
-        """异步记录用户活动日志"""
+        """异步记录用户活动日志（兼容现有调用，实际写入由后台任务批量完成）"""
+        self.enqueue_user_activity(user_id, action, resource_type, resource_id, details, ip_address, user_agent)
+    
+    async def _write_activity_logs(self, rows: list):
+        """将一批活动日志通过 COPY 协议写入数据库"""
+        # user_id 为 NOT NULL 列，未知用户的登录失败记录无法写入，跳过以免整批 COPY 失败
+        rows = [row for row in rows if row[0] is not None]
+        if not rows:
+            return
         try:
-            import json
             async with get_async_db_connection() as conn:
-                # 将字典转换为JSON字符串
-                details_json = json.dumps(details) if details else None
-                
-                await conn.execute(
-                    "INSERT INTO user_activity_logs (user_id, action, resource_type, resource_id, details, ip_address, user_agent) VALUES ($1, $2, $3, $4, $5, $6, $7)",
-                    user_id, action, resource_type, resource_id, details_json, ip_address, user_agent
-                )
-                
+                try:
+                    await conn.copy_records_to_table('user_activity_logs', records=rows, columns=ACTIVITY_LOG_COLUMNS)
+                    return
+                except asyncpg.PostgresError as e:
+                    # 整批 COPY 失败（如某条日志的用户刚被删除触发外键约束），逐条写入以保留其余日志
+                    logger.warning(f"Activity log COPY failed ({len(rows)} rows), falling back to per-row insert: {e}")
+                failed = 0
+                for row in rows:
+                    try:
+                        await conn.execute(INSERT_ACTIVITY_LOG_SQL, *row)
+                    except asyncpg.PostgresError:
+                        failed += 1
+                if failed:
+                    logger.error(f"Error logging user activity: {failed}/{len(rows)} rows rejected")
         except Exception as e:
-            logger.error(f"Error logging user activity: {e}")
+            logger.error(f"Error logging user activity ({len(rows)} rows): {e}")
+    
+    async def _drain_activity_logs(self):
+        """后台任务：等待队列中的日志，每次取出当前已排队的最多一批写入；取到停止标记时写完当前批次后退出"""
+        queue = self._activity_log_queue
+        stop = False
+        while not stop:
+            rows = []
+            row = await queue.get()
+            while True:
+                if row is _ACTIVITY_LOG_STOP:
+                    stop = True
+                    break
+                rows.append(row)
+                if len(rows) >= ACTIVITY_LOG_BATCH_SIZE or queue.empty():
+                    break
+                row = queue.get_nowait()
+            if rows:
+                await self._write_activity_logs(rows)
+    
+    async def flush_activity_logs(self):
+        """停止后台写入任务并写入队列中剩余的日志，通常在应用关闭时调用
+        
+        向队列放入停止标记并等待后台任务退出，正在写入的批次和标记之前排队的日志都会写完。
+        """
+        task = self._activity_log_task
+        if task is not None and not task.done():
+            await self._activity_log_queue.put(_ACTIVITY_LOG_STOP)
+            await task
+        self._activity_log_task = None
+        queue = self._activity_log_queue
+        while queue is not None and not queue.empty():
+            rows = []
+            while len(rows) < ACTIVITY_LOG_BATCH_SIZE and not queue.empty():
+                rows.append(queue.get_nowait())
+            await self._write_activity_logs(rows)
     
     def cleanup_expired_redis_sessions(self):
         """清理过期的Redis会话（可选方法，Redis会自动过期）"""
@@ -1,11 +1,14 @@
 import asyncio
+import asyncpg
 import json
 import logging
 import fnmatch
 import sys
 import os
 import threading
-from typing import Optional, Dict, Any, Union
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any
 from datetime import timedelta, datetime
 
 # 自定义异常类
@@ -23,7 +26,7 @@ class CacheOperationError(CacheError):
 
 # 添加父目录到路径以导入配置
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from redis_config import REDIS_CONFIG, CACHE_EXPIRY, CACHE_PREFIX
+from redis_config import REDIS_CONFIG, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT, CACHE_EXPIRY, CACHE_PREFIX
 
 # 异步Redis支持
 try:
@@ -33,16 +36,58 @@ except ImportError:
     ASYNC_REDIS_AVAILABLE = False
     logging.warning("aioredis未安装，异步功能将受限")
 
+# 大缓存值压缩支持
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+    logging.warning("zstandard未安装，缓存值将不压缩")
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 从 REDIS_CONFIG 传给 aioredis 连接的参数（aioredis 2.x 不支持 retry_on_error 和自定义重试策略）
+REDIS_CONNECTION_OPTIONS = (
+    'socket_connect_timeout', 'socket_timeout', 'socket_keepalive',
+    'socket_keepalive_options', 'retry_on_timeout', 'health_check_interval'
+)
+
+# 带标签的缓存键前缀：写入时把键登记到标签集合，失效时按集合删除，避免 KEYS 全库扫描
+CACHE_TAGGED_PREFIXES = ('uploaded_files:',)
+CACHE_TAG_KEY_PREFIX = 'cache_tags:'
+
+# 进程内一级缓存：高频轮询的列表接口先查本进程，命中时省去一次Redis往返和JSON解析
+# 失效操作（clear_pattern/invalidate_tag/bump_version）只能清除当前进程的一级缓存，
+# 多进程运行（WEB_CONCURRENCY > 1）时其他进程最多会在 L1_CACHE_TTL 秒内返回旧数据，因此多进程时不启用一级缓存
+L1_CACHE_ENABLED = max(1, int(os.getenv('WEB_CONCURRENCY', 1))) == 1
+L1_CACHE_PREFIXES = ('uploaded_files:', 'user_projects:', 'parts:') if L1_CACHE_ENABLED else ()
+L1_CACHE_MAX_SIZE = 4096
+L1_CACHE_TTL = 10
+
+# 缓存版本号键前缀：版本号拼入缓存键，递增版本号即可使整个命名空间的旧缓存失效（旧键随过期时间自然清除）
+CACHE_VERSION_KEY_PREFIX = 'cache_version:'
+
+# 按模式清除缓存时每次 SCAN 的提示数量，同时也是每批 UNLINK 的键数
+CACHE_SCAN_COUNT = 500
+
+# 超过该长度的缓存值使用zstd压缩后写入Redis；读取时按zstd帧头识别，未压缩的旧值照常读取
+CACHE_COMPRESS_MIN_BYTES = 4096
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+if ZSTD_AVAILABLE:
+    _zstd_compressor = zstandard.ZstdCompressor(level=3)
+    _zstd_decompressor = zstandard.ZstdDecompressor()
+
 class AsyncCacheService:
     def __init__(self, config=None):
         """初始化异步Redis缓存服务"""
         self.config = config or REDIS_CONFIG
         self.redis_client: Optional[aioredis.Redis] = None
+        self._redis_raw_client: Optional[aioredis.Redis] = None  # 不解码响应，用于读取压缩的缓存值
         self._memory_cache = {}
         self._memory_cache_lock = threading.Lock()
+        self._memory_versions: Dict[str, int] = {}  # 无Redis时的缓存版本号
+        self._l1_cache = OrderedDict()  # key -> (过期时间, 已解析的值)
         self._initialized = False
     
     async def initialize(self):
@@ -52,15 +97,33 @@ class AsyncCacheService:
         
         if ASYNC_REDIS_AVAILABLE:
             try:
-                self.redis_client = aioredis.from_url(
+                # 连接超时、TCP保活与健康检查参数，避免Redis失联时请求长时间挂起
+                connection_options = {
+                    option: self.config[option] for option in REDIS_CONNECTION_OPTIONS if option in self.config
+                }
+                # 使用有上限的阻塞连接池，连接用尽时排队等待空闲连接
+                self.redis_client = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(
                     f"redis://{self.config['host']}:{self.config['port']}",
                     db=self.config.get('db', 0),
                     password=self.config.get('password'),
                     encoding="utf-8",
-                    decode_responses=True
-                )
+                    decode_responses=True,
+                    max_connections=REDIS_MAX_CONNECTIONS,
+                    timeout=REDIS_POOL_TIMEOUT,
+                    **connection_options
+                ))
                 # 测试连接
                 await self.redis_client.ping()
+                if ZSTD_AVAILABLE:
+                    self._redis_raw_client = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(
+                        f"redis://{self.config['host']}:{self.config['port']}",
+                        db=self.config.get('db', 0),
+                        password=self.config.get('password'),
+                        decode_responses=False,
+                        max_connections=REDIS_MAX_CONNECTIONS,
+                        timeout=REDIS_POOL_TIMEOUT,
+                        **connection_options
+                    ))
                 logger.info(f"异步Redis缓存服务连接成功 - {self.config['host']}:{self.config['port']}")
             except aioredis.ConnectionError as e:
                 logger.warning(f"Redis连接错误，将使用内存缓存: {e}")
@@ -78,11 +141,45 @@ class AsyncCacheService:
         self._initialized = True
     
     def _json_serializer(self, obj):
-        """自定义JSON序列化器，处理datetime对象"""
+        """自定义JSON序列化器，处理datetime对象和asyncpg查询结果"""
         if isinstance(obj, datetime):
             return obj.isoformat()
+        if isinstance(obj, asyncpg.Record):
+            return dict(obj)
         raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
     
+    def _l1_get(self, key: str) -> Optional[Any]:
+        """从进程内一级缓存读取，过期或不存在时返回None"""
+        item = self._l1_cache.get(key)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del self._l1_cache[key]
+            return None
+        self._l1_cache.move_to_end(key)
+        return item[1]
+    
+    def _l1_set(self, key: str, value: Any, expire: int):
+        """写入进程内一级缓存（仅限 L1_CACHE_PREFIXES 下的键），超出容量时淘汰最久未使用的项"""
+        if not key.startswith(L1_CACHE_PREFIXES):
+            return
+        self._l1_cache[key] = (time.monotonic() + min(expire, L1_CACHE_TTL), value)
+        self._l1_cache.move_to_end(key)
+        if len(self._l1_cache) > L1_CACHE_MAX_SIZE:
+            self._l1_cache.popitem(last=False)
+    
+    def _l1_clear_pattern(self, pattern: str):
+        """清除进程内一级缓存中匹配模式的键"""
+        for key in [key for key in self._l1_cache if fnmatch.fnmatch(key, pattern)]:
+            del self._l1_cache[key]
+    
+    def _cache_tag(self, key: str) -> Optional[str]:
+        """返回缓存键所属的标签，不属于任何标签时返回None"""
+        for prefix in CACHE_TAGGED_PREFIXES:
+            if key.startswith(prefix):
+                return prefix[:-1]
+        return None
+    
     async def set(self, key: str, value: Any, expire: int = None, cache_type: str = 'default') -> bool:
         """异步设置缓存"""
         if not self._initialized:
@@ -93,11 +190,22 @@ class AsyncCacheService:
                 expire = CACHE_EXPIRY.get(cache_type, CACHE_EXPIRY['default'])
             
             if self.redis_client:
+                self._l1_set(key, value, expire)
                 if isinstance(value, bool):
                     value = json.dumps(value)  # 将布尔值转换为JSON字符串
                 elif isinstance(value, (dict, list)):
                     value = json.dumps(value, default=self._json_serializer, ensure_ascii=False)
-                result = await self.redis_client.setex(key, expire, value)
+                if self._redis_raw_client and isinstance(value, str) and len(value) > CACHE_COMPRESS_MIN_BYTES:
+                    value = _zstd_compressor.compress(value.encode('utf-8'))
+                tag = self._cache_tag(key)
+                if tag:
+                    # 写入缓存并登记到标签集合，一次往返完成
+                    async with self.redis_client.pipeline(transaction=False) as pipe:
+                        pipe.setex(key, expire, value)
+                        pipe.sadd(f"{CACHE_TAG_KEY_PREFIX}{tag}", key)
+                        result = (await pipe.execute())[0]
+                else:
+                    result = await self.redis_client.setex(key, expire, value)
                 if result:
                     logger.info(f"Redis缓存设置成功: {key}, 过期时间: {expire}秒")
                 else:
@@ -131,13 +239,25 @@ class AsyncCacheService:
         """异步获取缓存"""
         try:
             if self.redis_client:
-                value = await self.redis_client.get(key)
+                value = self._l1_get(key)
+                if value is not None:
+                    return value
+                if self._redis_raw_client:
+                    value = await self._redis_raw_client.get(key)
+                    if value:
+                        if value.startswith(ZSTD_MAGIC):
+                            value = _zstd_decompressor.decompress(value)
+                        value = value.decode('utf-8')
+                else:
+                    value = await self.redis_client.get(key)
                 if value:
                     logger.info(f"缓存命中: {key}")
                     try:
-                        return json.loads(value)
+                        value = json.loads(value)
                     except json.JSONDecodeError:
-                        return value
+                        pass
+                    self._l1_set(key, value, L1_CACHE_TTL)
+                    return value
                 else:
                     logger.info(f"缓存未命中: {key}")
                 return None
@@ -163,6 +283,7 @@ class AsyncCacheService:
     async def delete(self, key: str) -> bool:
         """异步删除缓存"""
         try:
+            self._l1_cache.pop(key, None)
             if self.redis_client:
                 result = await self.redis_client.delete(key)
                 logger.info(f"Redis删除缓存: {key}, 结果: {result}")
@@ -205,15 +326,20 @@ class AsyncCacheService:
     async def clear_pattern(self, pattern: str) -> int:
         """异步清除匹配模式的缓存"""
         try:
+            self._l1_clear_pattern(pattern)
             if self.redis_client:
-                keys = await self.redis_client.keys(pattern)
-                if keys:
-                    deleted_count = await self.redis_client.delete(*keys)
-                    logger.info(f"Redis清除模式缓存: {pattern}, 匹配键: {len(keys)}, 删除: {deleted_count}")
-                    return deleted_count
-                else:
-                    logger.info(f"Redis清除模式缓存: {pattern}, 未找到匹配的键")
-                return 0
+                # 使用 SCAN 增量遍历代替阻塞的 KEYS，匹配到的键分批 UNLINK（由Redis后台线程释放内存）
+                deleted_count = 0
+                batch = []
+                async for key in self.redis_client.scan_iter(match=pattern, count=CACHE_SCAN_COUNT):
+                    batch.append(key)
+                    if len(batch) >= CACHE_SCAN_COUNT:
+                        deleted_count += await self.redis_client.unlink(*batch)
+                        batch = []
+                if batch:
+                    deleted_count += await self.redis_client.unlink(*batch)
+                logger.info(f"Redis清除模式缓存: {pattern}, 删除: {deleted_count}")
+                return deleted_count
             else:
                 # 内存缓存的模式匹配
                 with self._memory_cache_lock:
@@ -227,6 +353,61 @@ class AsyncCacheService:
             logger.error(f"清除模式缓存失败: {e}")
             return 0
     
+    async def get_version(self, namespace: str) -> int:
+        """异步获取命名空间当前的缓存版本号，未设置时为0"""
+        try:
+            if self.redis_client:
+                version = await self.redis_client.get(f"{CACHE_VERSION_KEY_PREFIX}{namespace}")
+                return int(version) if version else 0
+            return self._memory_versions.get(namespace, 0)
+        except Exception as e:
+            logger.error(f"获取缓存版本号失败 {namespace}: {e}")
+            return 0
+    
+    async def bump_version(self, namespace: str) -> int:
+        """异步递增命名空间的缓存版本号，使该命名空间下所有带版本号的缓存键失效"""
+        try:
+            self._l1_clear_pattern(f"{namespace}:*")
+            if self.redis_client:
+                version = await self.redis_client.incr(f"{CACHE_VERSION_KEY_PREFIX}{namespace}")
+            else:
+                version = self._memory_versions.get(namespace, 0) + 1
+                self._memory_versions[namespace] = version
+            logger.info(f"缓存版本号递增: {namespace} -> {version}")
+            return version
+        except Exception as e:
+            logger.error(f"递增缓存版本号失败 {namespace}: {e}")
+            return 0
+    
+    async def invalidate_namespace(self, patterns: list) -> int:
+        """异步并发清除多个模式的缓存，返回删除的键总数"""
+        results = await asyncio.gather(*(self.clear_pattern(pattern) for pattern in patterns))
+        return sum(results)
+    
+    async def invalidate_tag(self, tag: str) -> int:
+        """异步清除某个标签下登记的所有缓存（标签即键前缀去掉末尾冒号，如 uploaded_files）"""
+        try:
+            self._l1_clear_pattern(f"{tag}:*")
+            if self.redis_client:
+                tag_key = f"{CACHE_TAG_KEY_PREFIX}{tag}"
+                keys = await self.redis_client.smembers(tag_key)
+                if not keys:
+                    logger.info(f"Redis清除标签缓存: {tag}, 未找到登记的键")
+                    return 0
+                # 只移除本次删除的成员，期间新登记的键保留在集合中
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    pipe.delete(*keys)
+                    pipe.srem(tag_key, *keys)
+                    deleted_count = (await pipe.execute())[0]
+                logger.info(f"Redis清除标签缓存: {tag}, 登记键: {len(keys)}, 删除: {deleted_count}")
+                return deleted_count
+            else:
+                # 内存缓存按前缀清除
+                return await self.clear_pattern(f"{tag}:*")
+        except Exception as e:
+            logger.error(f"清除标签缓存失败: {e}")
+            return 0
+    
     async def get_stats(self) -> Dict[str, Any]:
         """异步获取缓存统计信息"""
         try:
@@ -340,9 +521,13 @@ class AsyncCacheService:
         try:
             if self.redis_client:
                 await self.redis_client.close()
+                if self._redis_raw_client:
+                    await self._redis_raw_client.close()
+                    self._redis_raw_client = None
                 logger.info("Redis连接已关闭")
             
             # 清理内存缓存
+            self._l1_cache.clear()
             with self._memory_cache_lock:
                 self._memory_cache.clear()
             logger.info("内存缓存已清理")
@@ -1,13 +1,14 @@
 import asyncpg
 from typing import List, Dict, Optional
 import logging
-from db import get_async_db_connection
+from db import get_async_db_connection, with_db_retry
 
 logger = logging.getLogger(__name__)
 
 
 # 异步版本的分类服务函数
 
+@with_db_retry()
 async def get_all_categories_async() -> List[Dict]:
     """
     异步获取所有分类
@@ -39,6 +40,7 @@ async def get_all_categories_async() -> List[Dict]:
         logger.error(f"异步获取分类列表失败: {str(e)}")
         raise e
 
+@with_db_retry()
 async def get_category_by_id_async(category_id: int) -> Optional[Dict]:
     """
     异步根据ID获取分类
@@ -218,6 +220,7 @@ async def assign_project_to_category_async(project_name: str, file_unique_id: st
         logger.error(f"异步分配项目到分类失败: {str(e)}")
         raise e
 
+@with_db_retry()
 async def get_projects_by_category_async(category_id: int) -> List[Dict]:
     """
     异步获取指定分类下的所有项目
@@ -1,8 +1,32 @@
-from db import get_async_db_connection
+from db import get_async_db_connection, with_db_retry
 import os
 import uuid
 from datetime import datetime
 
+# 上传文件信息查询返回的列
+UPLOADED_FILE_COLUMNS = (
+    "id, file_unique_id, original_filename, file_size, file_type, "
+    "upload_time, project_name, status, rows_imported, error_message, category_id"
+)
+
+def _uploaded_file_to_dict(row):
+    """将 uploaded_files 查询结果转换为接口返回的文件信息字典"""
+    return {
+        "id": row['id'],
+        "file_unique_id": row['file_unique_id'],
+        "original_filename": row['original_filename'],
+        "file_size": row['file_size'],
+        "file_type": row['file_type'],
+        "upload_time": row['upload_time'].isoformat() if row['upload_time'] else "",
+        "project_name": row['project_name'],
+        "status": row['status'],
+        "rows_imported": row['rows_imported'],
+        "error_message": row['error_message'],
+        "category_id": row['category_id'],
+        "created_at": "",  # 确保返回空字符串而不是None
+        "updated_at": ""  # 确保返回空字符串而不是None
+    }
+
 async def save_uploaded_file_info_async(original_filename, file_size, project_name, file_unique_id, status="imported", rows_imported=0, error_message=None, category_id=None):
     """
     异步保存上传文件信息到数据库
@@ -48,6 +72,7 @@ async def save_uploaded_file_info_async(original_filename, file_size, project_na
         raise e
 
 
+@with_db_retry()
 async def get_uploaded_files_async(project_name=None):
     """
     异步获取上传文件列表
@@ -76,28 +101,11 @@ async def get_uploaded_files_async(project_name=None):
                     ORDER BY upload_time DESC
                 """)
             
-            result = []
-            for row in rows:
-                result.append({
-                    "id": row['id'],
-                    "file_unique_id": row['file_unique_id'],
-                    "original_filename": row['original_filename'],
-                    "file_size": row['file_size'],
-                    "file_type": row['file_type'],
-                    "upload_time": row['upload_time'].isoformat() if row['upload_time'] else "",
-                    "project_name": row['project_name'],
-                    "status": row['status'],
-                    "rows_imported": row['rows_imported'],
-                    "error_message": row['error_message'],
-                    "category_id": row['category_id'],
-                    "created_at": "",  # 确保返回空字符串而不是None
-                    "updated_at": ""
-                })
-            
-            return result
+            return [_uploaded_file_to_dict(row) for row in rows]
     except Exception as e:
         raise e
 
+@with_db_retry()
 async def get_uploaded_file_async(file_unique_id):
     """
     异步获取单个上传文件信息
@@ -123,21 +131,7 @@ async def get_uploaded_file_async(file_unique_id):
                 print(f"[FILE_SERVICE] 文件未找到，文件ID: {file_unique_id}")
                 return None
             
-            file_info = {
-                "id": row['id'],
-                "file_unique_id": row['file_unique_id'],
-                "original_filename": row['original_filename'],
-                "file_size": row['file_size'],
-                "file_type": row['file_type'],
-                "upload_time": row['upload_time'].isoformat() if row['upload_time'] else "",
-                "project_name": row['project_name'],
-                "status": row['status'],
-                "rows_imported": row['rows_imported'],
-                "error_message": row['error_message'],
-                "category_id": row['category_id'],
-                "created_at": "",  # 确保返回空字符串而不是None
-                "updated_at": ""  # 确保返回空字符串而不是None
-            }
+            file_info = _uploaded_file_to_dict(row)
             
             print(f"[FILE_SERVICE] 文件查询成功: {file_info['original_filename']} (项目: {file_info['project_name']}, 分类ID: {file_info['category_id']})")
             return file_info
@@ -155,19 +149,19 @@ async def update_file_name_async(file_unique_id, new_filename):
         new_filename (str): 新的文件名
     
     Returns:
-        bool: 更新是否成功
+        dict: 更新后的文件信息，文件不存在时返回 None
     """
     try:
         async with get_async_db_connection() as conn:
-            # 更新文件名
-            result = await conn.execute("""
+            # 更新文件名并直接返回更新后的记录
+            row = await conn.fetchrow(f"""
                 UPDATE uploaded_files
                 SET original_filename = $1
                 WHERE file_unique_id = $2
+                RETURNING {UPLOADED_FILE_COLUMNS}
             """, new_filename, file_unique_id)
             
-            # 检查是否有行被更新
-            return result.split()[-1] != '0'
+            return _uploaded_file_to_dict(row) if row else None
     except Exception as e:
         raise e
 
@@ -180,30 +174,28 @@ async def update_project_name_async(file_unique_id, new_project_name):
         new_project_name (str): 新的项目名称
     
     Returns:
-        bool: 更新是否成功
+        dict: 更新后的文件信息，文件不存在时返回 None
     """
     try:
         async with get_async_db_connection() as conn:
-            # 首先获取旧的项目名称，用于更新merged_projects表
-            old_project_name_row = await conn.fetchrow("""
-                SELECT project_name FROM uploaded_files
-                WHERE file_unique_id = $1
-            """, file_unique_id)
-            
-            if not old_project_name_row:
-                return False
+            async with conn.transaction():
+                # 更新uploaded_files表中的项目名称，同时取回旧的项目名称用于更新merged_projects表
+                row = await conn.fetchrow(f"""
+                    UPDATE uploaded_files AS u
+                    SET project_name = $1
+                    FROM (
+                        SELECT id, project_name AS old_project_name
+                        FROM uploaded_files
+                        WHERE file_unique_id = $2
+                        FOR UPDATE
+                    ) AS old
+                    WHERE u.id = old.id
+                    RETURNING {', '.join(f'u.{column}' for column in UPLOADED_FILE_COLUMNS.split(', '))}, old.old_project_name
+                """, new_project_name, file_unique_id)
+                
+                if not row:
+                    return None
                 
-            old_project_name = old_project_name_row['project_name']
-            
-            # 更新uploaded_files表中的项目名称
-            result = await conn.execute("""
-                UPDATE uploaded_files
-                SET project_name = $1
-                WHERE file_unique_id = $2
-            """, new_project_name, file_unique_id)
-            
-            # 如果找到并更新了uploaded_files表中的记录
-            if result.split()[-1] != '0':
                 # 同时更新parts_library表中的项目名称
                 await conn.execute("""
                     UPDATE parts_library
@@ -216,75 +208,8 @@ async def update_project_name_async(file_unique_id, new_project_name):
                     UPDATE merged_projects
                     SET source_projects = array_replace(source_projects, $1, $2)
                     WHERE $1 = ANY(source_projects)
-                """, old_project_name, new_project_name)
+                """, row['old_project_name'], new_project_name)
                 
-                return True
-            else:
-                return False
-    except Exception as e:
-        raise e
-
-
-    """
-    更新项目名称
-    
-    Args:
-        file_unique_id (str): 文件唯一ID
-        new_project_name (str): 新的项目名称
-    
-    Returns:
-        bool: 更新是否成功
-    """
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    try:
-        # 首先获取旧的项目名称，用于更新merged_projects表
-        cur.execute("""
-            SELECT project_name FROM uploaded_files
-            WHERE file_unique_id = %s
-        """, (file_unique_id,))
-        
-        old_project_name_row = cur.fetchone()
-        if not old_project_name_row:
-            return False
-            
-        old_project_name = old_project_name_row[0]
-        
-        # 更新uploaded_files表中的项目名称
-        cur.execute("""
-            UPDATE uploaded_files
-            SET project_name = %s
-            WHERE file_unique_id = %s
-            RETURNING id
-        """, (new_project_name, file_unique_id))
-        
-        row = cur.fetchone()
-        
-        # 如果找到并更新了uploaded_files表中的记录
-        if row is not None:
-            # 同时更新parts_library表中的项目名称
-            cur.execute("""
-                UPDATE parts_library
-                SET project_name = %s
-                WHERE file_unique_id = %s
-            """, (new_project_name, file_unique_id))
-            
-            # 更新merged_projects表中source_projects数组中的项目名称
-            cur.execute("""
-                UPDATE merged_projects
-                SET source_projects = array_replace(source_projects, %s, %s)
-                WHERE %s = ANY(source_projects)
-            """, (old_project_name, new_project_name, old_project_name))
-            
-            conn.commit()
-            return True
-        else:
-            conn.rollback()
-            return False
+                return _uploaded_file_to_dict(row)
     except Exception as e:
-        conn.rollback()
         raise e
-    finally:
-        cur.close()
-        conn.close()
\ No newline at end of file
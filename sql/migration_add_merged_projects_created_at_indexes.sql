@@ -0,0 +1,9 @@
+-- 为合并项目列表查询添加索引的迁移脚本
+-- 用于 /merged_projects：管理员按 created_at 倒序查询全部，普通用户按 created_by 过滤后按 created_at 倒序，均可直接走索引避免排序
+-- 使用 CONCURRENTLY 不阻塞写入，不能放在事务块中执行
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_merged_projects_created_at
+ON merged_projects (created_at DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_merged_projects_owner_created
+ON merged_projects (created_by, created_at DESC);
@@ -0,0 +1,10 @@
+-- 为按分类权限过滤的文件/项目列表查询添加索引的迁移脚本
+-- 用于 /uploaded_files 与 /user-projects：
+--   user_category_permissions(user_id) -> uploaded_files(category_id) 按上传时间倒序 -> parts_library(file_unique_id)
+
+CREATE INDEX IF NOT EXISTS idx_uploaded_files_category_upload_time
+ON uploaded_files (category_id, upload_time DESC)
+INCLUDE (file_unique_id, original_filename, project_name, file_size, status, rows_imported);
+
+CREATE INDEX IF NOT EXISTS idx_parts_library_file_unique_id
+ON parts_library (file_unique_id);
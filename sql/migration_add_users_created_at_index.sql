@@ -0,0 +1,6 @@
+-- 为用户列表分页查询添加覆盖索引的迁移脚本
+-- 用于 /api/auth/users：ORDER BY created_at DESC LIMIT/OFFSET 可直接走索引，避免排序
+
+CREATE INDEX IF NOT EXISTS idx_users_created_at_desc
+ON users (created_at DESC)
+INCLUDE (id, username, email, full_name, role, is_active, last_login);